@@ -0,0 +1,101 @@
+"""
+Compare the throughput of reading .c files with chardet on every file (the previous approach)
+and with the UTF-8-first decoder used by dataset_creation.py, on a synthetic corpus.
+
+Usage: python benchmarks/decoding.py [--files 2000] [--latin1-share 0.02]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import chardet
+
+# dataset_creation reads its directories from the environment, they aren't used here
+os.environ.setdefault('DATASET_SRC', 'out/source')
+os.environ.setdefault('DATASET_TARGET', 'out/code_dataset')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dataset_creation import decode_source  # noqa: E402
+
+FUNCTION = '''
+/* helper number {n}: returns the sum of its arguments */
+static int helper_{n}(int a, int b)
+{{
+    // {comment}
+    int result = a + b;
+    printf("helper_{n}: %d\\n", result);
+    return result;
+}}
+'''
+
+
+def generate_file(path: str, functions: int, comment: str, encoding: str):
+    body = '#include <stdio.h>\n' + ''.join(FUNCTION.format(n=n, comment=comment) for n in range(functions))
+    body += '\nint main(void)\n{\n    return helper_0(1, 2);\n}\n'
+    with open(path, 'w', encoding=encoding) as f:
+        f.write(body)
+
+
+def generate_corpus(target: str, files: int, latin1_share: float) -> list[str]:
+    rng = random.Random(0)
+    paths = []
+    for i in range(files):
+        path = os.path.join(target, f"file{i}.c")
+        # sizes from a few hundred bytes to ~100 KB, skewed towards small files like real repos
+        functions = int(rng.paretovariate(1.2)) * 3
+        if rng.random() < latin1_share:
+            generate_file(path, functions, 'résumé façade naïve', 'latin-1')
+        elif rng.random() < 0.1:
+            generate_file(path, functions, 'UTF-8 comment: ≥ ≤ µs', 'utf-8')
+        else:
+            generate_file(path, functions, 'plain ASCII comment', 'ascii')
+        paths.append(path)
+    return paths
+
+
+def read_with_chardet(path: str) -> str:
+    with open(path, 'rb') as f:
+        raw_data = f.read()
+    encoding = chardet.detect(raw_data)['encoding']
+    with open(path, 'r', encoding=encoding) as f:
+        return f.read()
+
+
+def read_tiered(path: str) -> str:
+    with open(path, 'rb') as f:
+        raw_data = f.read()
+    return decode_source(raw_data)[0]
+
+
+def measure(read, paths: list[str]) -> (float, list[str]):
+    start = time.perf_counter()
+    texts = [read(path) for path in paths]
+    return len(paths) / (time.perf_counter() - start), texts
+
+
+def main(files: int, latin1_share: float):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = generate_corpus(tmp_dir, files, latin1_share)
+        total_mb = sum(os.path.getsize(p) for p in paths) / 1024 / 1024
+        print(f"Corpus: {files} files, {total_mb:.1f} MB, {latin1_share:.0%} Latin-1")
+
+        old_rate, old_texts = measure(read_with_chardet, paths)
+        new_rate, new_texts = measure(read_tiered, paths)
+        mismatches = sum(a != b for a, b in zip(old_texts, new_texts))
+
+        print(f"chardet on every file: {old_rate:10.1f} files/s")
+        print(f"UTF-8 first:           {new_rate:10.1f} files/s  ({new_rate / old_rate:.1f}x)")
+        print(f"Files decoded differently: {mismatches}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=2000, help="Number of files in the corpus (default 2000)")
+    parser.add_argument('--latin1-share', type=float, default=0.02,
+                        help="Share of files that are not valid UTF-8 (default 0.02)")
+    args = parser.parse_args()
+    main(args.files, args.latin1_share)
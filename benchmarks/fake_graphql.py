@@ -0,0 +1,126 @@
+"""
+Fake GitHub GraphQL endpoint for the batched metadata lookup of the scraper (src.scraper --graphql).
+It answers the repo queries of fetch_repo_metadata from the sample repos in benchmarks/data/graphql_repos.json,
+in the format of the GitHub API: unknown repos are null with a NOT_FOUND error, and the first responses can be
+made rate limited (errors without data).
+
+Usage: python benchmarks/fake_graphql.py [--port 8770] [--rate-limited 0]
+       then set GRAPHQL_ENDPOINT=http://127.0.0.1:8770 in .env
+       python benchmarks/fake_graphql.py --check
+       runs fetch_repo_metadata against the fake endpoint and checks the parsed results
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+REPOS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'graphql_repos.json')
+ALIAS_PATTERN = re.compile(r'(r\d+): repository\(owner: \$(owner\d+), name: \$(name\d+)\)')
+
+
+class FakeGraphQL(BaseHTTPRequestHandler):
+    repos: dict[str, dict] = {}
+    rate_limited = 0  # number of requests that are still answered with a rate limit error
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body: dict, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        FakeGraphQL.requests += 1
+        if FakeGraphQL.rate_limited > 0:
+            FakeGraphQL.rate_limited -= 1
+            self._reply({'errors': [{'type': 'RATE_LIMITED', 'message': 'API rate limit exceeded'}]},
+                        {'x-ratelimit-remaining': '0', 'x-ratelimit-reset': str(int(time.time()) + 1)})
+            return
+
+        variables = request.get('variables', {})
+        aliases = ALIAS_PATTERN.findall(request.get('query', ''))
+        if not aliases:
+            self._reply({'errors': [{'message': 'Parse error on query'}]})
+            return
+        data = {}
+        errors = []
+        for alias, owner, name in aliases:
+            full_name = f"{variables[owner]}/{variables[name]}"
+            data[alias] = self.repos.get(full_name)
+            if data[alias] is None:
+                errors.append({'type': 'NOT_FOUND', 'path': [alias],
+                               'message': f"Could not resolve to a Repository with the name '{full_name}'."})
+        self._reply({'data': data, 'errors': errors} if errors else {'data': data})
+
+
+def serve(port: int, rate_limited: int = 0) -> ThreadingHTTPServer:
+    with open(REPOS_FILE, 'rt', encoding='utf-8') as f:
+        FakeGraphQL.repos = json.load(f)
+    FakeGraphQL.rate_limited = rate_limited
+    return ThreadingHTTPServer(('127.0.0.1', port), FakeGraphQL)
+
+
+def check(port: int):
+    # the scraper reads its settings from the environment when it's imported
+    os.environ['GRAPHQL_ENDPOINT'] = f'http://127.0.0.1:{port}'
+    os.environ['HTTP_CACHE'] = '0'
+    os.environ.setdefault('SIZE_LIMIT', '-1')
+    os.environ.setdefault('SOURCE_DIR', 'out/source')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from src.scraper import GraphQLError, fetch_repo_metadata
+
+    server = serve(port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    names = ['octo/hello-c', 'octo/no-release', 'octo/empty', 'octo/missing']
+
+    metadata = fetch_repo_metadata(names)
+    expected = {
+        'octo/hello-c': {'size': 412, 'stars': 1520, 'commit': '9fceb02', 'languages': {'C': 48211, 'Makefile': 1920}},
+        'octo/no-release': {'size': 96, 'stars': 37, 'commit': 'e83c516', 'languages': {'C': 10344, 'Shell': 2210}},
+        'octo/empty': {'size': 0, 'stars': 2, 'commit': None, 'languages': {}},
+    }
+    for name, fields in expected.items():
+        assert {key: metadata[name][key] for key in fields} == fields, (name, metadata[name])
+    assert metadata['octo/missing'] is None
+    print(f"Batch of {len(names)} repos: parsed in {FakeGraphQL.requests} request, missing repo is None")
+
+    FakeGraphQL.requests = 0
+    FakeGraphQL.rate_limited = 1
+    assert fetch_repo_metadata(names) == metadata
+    print(f"Rate limited batch: same result after {FakeGraphQL.requests} requests")
+
+    FakeGraphQL.rate_limited = 100
+    try:
+        fetch_repo_metadata(names)
+    except GraphQLError as e:
+        print(f"Batch that stays rate limited: GraphQLError ({e})")
+    else:
+        raise AssertionError("no error for a batch that stays rate limited")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8770, help="Port of the fake endpoint (default 8770)")
+    parser.add_argument('--rate-limited', type=int, default=0,
+                        help="Number of requests answered with a rate limit error first (default 0)")
+    parser.add_argument('--check', action='store_true', help="Check fetch_repo_metadata against the fake endpoint")
+    args = parser.parse_args()
+    if args.check:
+        check(args.port)
+    else:
+        print(f"Fake GraphQL endpoint on http://127.0.0.1:{args.port}")
+        serve(args.port, args.rate_limited).serve_forever()
@@ -3,50 +3,179 @@ Process a directory of downloaded repos to create a JSONL dataset of C code.
 Only files that contain the main() function are considered.
 """
 
+import argparse
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
 import json
 import os
-import re
 
 import chardet
 from dotenv import load_dotenv
 from pycparser import parse_file
+from tqdm import tqdm
 
-from src.db_handler import initialize, wrapup, match_folder_to_row, EmptyDatasetError
+from src.c_scanner import scan_c_source
+from src.dedup import DedupIndex, fingerprint
+from src.db_handler import initialize, wrapup, match_folders_to_rows, EmptyDatasetError
 
 load_dotenv()
 DATASET_SRC = os.path.join(*os.getenv('DATASET_SRC').split('/'))
 DATASET_TARGET = os.path.join(*os.getenv('DATASET_TARGET').split('/'))
+DETECTION_SAMPLE_SIZE = 64 * 1024  # bytes passed to chardet when a file is not valid UTF-8
 
 
-def has_main_function(code: str) -> bool:
+def decode_source(raw_data: bytes) -> (str, str):
     """
-    Check whether given C code contains a main() function
-    :param code: Code to check in string format, newlines included
-    :return: True or False
+    Decode the contents of a source file
+    Most C files are ASCII or UTF-8, so strict UTF-8 is tried first, and encoding detection
+    only runs on a bounded sample of the files that fail it
+    :param raw_data: File contents
+    :return: Decoded text with normalized newlines (like reading in text mode) and the encoding that was used
+    :raises UnicodeDecodeError: If the file can't be decoded with the detected encoding
+    :raises LookupError: If no encoding could be detected
     """
-    # clean the code from comments to reduce false positives
-    pattern_comments = r'/\*[\s\S]*?\*/|//.*'
-    code_cleaned = re.sub(pattern_comments, '', code)
-    # check if the cleaned code contains a main function definition
-    pattern_main = r'\bmain\(.*?\)[\s\n]*{'
-    return bool(re.search(pattern_main, code_cleaned))
+    try:
+        # utf-8-sig is plain UTF-8 that also drops a byte order mark
+        code = raw_data.decode('utf-8-sig')
+        encoding = 'utf-8'
+    except UnicodeDecodeError:
+        encoding = chardet.detect(raw_data[:DETECTION_SAMPLE_SIZE])['encoding']
+        if encoding is None:
+            raise LookupError("no encoding detected")
+        code = raw_data.decode(encoding)
+    return code.replace('\r\n', '\n').replace('\r', '\n'), encoding
+
+
+class JsonlShardWriter:
+    """
+    Append dataset entries to a JSONL file as they are produced, optionally split into shards of limited size
+    Without a size limit, entries go to file_name as before; with a limit, they go to numbered shards
+    ('dataset-00000.jsonl', 'dataset-00001.jsonl', ...) and writing resumes in the last shard of a previous run
+    """
+    def __init__(self, file_name: str, save_to: str = DATASET_TARGET, shard_size: int = None):
+        """
+        :param file_name: .jsonl file name for the dataset
+        :param save_to: Directory where the JSONL should be saved; uses the .env setting by default
+        :param shard_size: Max size of a shard in bytes (optional, no sharding if not provided)
+        """
+        os.makedirs(save_to, exist_ok=True)
+        self.save_to = save_to
+        self.stem, self.ext = os.path.splitext(file_name)
+        self.shard_size = shard_size
+        self.shard = 0
+        if shard_size:
+            # continue after the shards written by previous runs
+            while os.path.isfile(self._shard_path(self.shard + 1)):
+                self.shard += 1
+            self.path = self._shard_path(self.shard)
+        else:
+            self.path = os.path.join(save_to, file_name)
+        self.file = open(self.path, 'a')
+
+    def _shard_path(self, shard: int) -> str:
+        return os.path.join(self.save_to, f"{self.stem}-{shard:05}{self.ext}")
+
+    def write(self, entry: dict):
+        line = json.dumps(entry) + "\n"
+        if self.shard_size and self.file.tell() > 0 and self.file.tell() + len(line) > self.shard_size:
+            self.file.close()
+            self.shard += 1
+            self.path = self._shard_path(self.shard)
+            self.file = open(self.path, 'a')
+        self.file.write(line)
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def iter_repo_entries(repo_folder: str, repo_name: str, stars: int, repo_size: int):
+    """
+    Generate a dataset entry for every .c file of a repo that has a main() function
+    :param repo_folder: Name of the repo folder in the dataset source directory
+    :param repo_name: Full name of the repo ('owner/repo')
+    :param stars: Number of stars of the repo
+    :param repo_size: Size of the repo in KB
+    :return: Generator of dictionaries
+    """
+    for root, _, files in os.walk(os.path.join(DATASET_SRC, repo_folder)):
+        for f in files:
+            # for every .c file, check if it has a main() function
+            if not f.endswith('.c'):
+                continue
+            filepath = os.path.join(root, f)
+
+            # read the file only once, in binary mode
+            with open(filepath, 'rb') as bin_file:
+                raw_data = bin_file.read()
+            try:
+                code, encoding = decode_source(raw_data)
+            except (UnicodeDecodeError, LookupError) as e:
+                print(f"Exception reading {filepath}: {e}")
+                continue
+
+            # the main() check and the extra features come from the same pass over the code
+            features = scan_c_source(code)
+            if not features['has_main']:
+                continue
+            # TODO check the file for well-formedness (maybe with gcc?)
+            yield {
+                'repo_name': repo_name,
+                'path': os.path.relpath(filepath, os.path.join(DATASET_SRC, repo_folder)),
+                'stars': stars,
+                'repo_size': repo_size,
+                'lines': features['lines'],
+                'functions': features['functions'],
+                'includes': features['includes'],
+                'code': code,
+            }
+
+
+def scan_repo(task: tuple[str, str, int, int, bool]) -> (str, list[dict], list[tuple]):
+    """
+    Collect the dataset entries of a single repo, to be run in a worker process
+    Only one repo's entries are held in memory at a time
+    :param task: Arguments for iter_repo_entries and whether to compute fingerprints for deduplication
+    :return: Repo name, its entries and their fingerprints (empty if not requested)
+    """
+    repo_folder, repo_name, stars, repo_size, dedup = task
+    entries = list(iter_repo_entries(repo_folder, repo_name, stars, repo_size))
+    fingerprints = [fingerprint(entry['code']) for entry in entries] if dedup else []
+    return repo_name, entries, fingerprints
 
 
-def serialize_to_jsonl(list_of_entries: list[dict], file_name: str, save_to=DATASET_TARGET):
+def bounded_map(pool: Executor, fn, tasks: list, in_flight: int):
     """
-    Process a list of dictionaries into a JSONL file
-    :param list_of_entries: List of dictionaries containing the data where each dictionary is a new entry in the dataset
-    :param file_name: .jsonl file name for the dataset
-    :param save_to: Directory where the JSONL should be saved; uses the .env setting by default
+    Like pool.map, but only submits a task when the result of an earlier one has been consumed,
+    so finished results don't pile up in memory while the caller is busy
+    :param pool: Executor to run the tasks in
+    :param fn: Function called with each task
+    :param tasks: Arguments of fn
+    :param in_flight: Max number of submitted tasks whose results haven't been consumed
+    :return: Generator of the results in the order of the tasks
     """
-    os.makedirs(save_to, exist_ok=True)
-    with open(os.path.join(save_to, file_name), 'a') as f:
-        for entry in list_of_entries:
-            json.dump(entry, f)
-            f.write("\n")
+    tasks = iter(tasks)
+    futures = deque(pool.submit(fn, task) for _, task in zip(range(in_flight), tasks))
+    while futures:
+        yield futures.popleft().result()
+        # the previous result has been dealt with
+        for task in tasks:
+            futures.append(pool.submit(fn, task))
+            break
 
 
-def main():
+def main(jobs: int = 1, shard_size: int = None, checkpoint: int = 50, dedup: str = 'skip'):
+    """
+    :param jobs: Number of worker processes scanning repos (default 1 scans in the main process)
+    :param shard_size: Max size of a dataset shard in bytes (optional, a single dataset.jsonl if not provided)
+    :param checkpoint: Number of repos after which the 'In_dataset' flags are saved
+    :param dedup: What to do with files that are (near-)duplicates of files already in the dataset:
+    'skip' them, 'tag' them with the original they duplicate or 'off' to not check at all
+    """
     df, _ = initialize()
     if df.empty:
         raise EmptyDatasetError()
@@ -55,59 +184,71 @@ def main():
     if 'In_dataset' not in df:
         df['In_dataset'] = False
 
-    dataset_entries = []
-
     # get a list of available repo folders
     folders = [x for x in os.listdir(DATASET_SRC) if os.path.isdir(os.path.join(DATASET_SRC, x))]
 
-    for repo_folder in folders:
-        # match every folder to df to get more data about the repo
-        df_row = match_folder_to_row(repo_folder, df)
-        # skip unmatched repos and those that are already tagged as in dataset
-        if df_row is None or df_row.In_dataset:
-            continue
-        for root, _, files in os.walk(os.path.join(DATASET_SRC, repo_folder)):
-            for f in files:
-                # for every .c file, check if it has a main() function
-                if not f.endswith('.c'):
-                    continue
-                filepath = os.path.join(root, f)
-
-                # read the file in binary mode to detect encoding
-                with open(filepath, 'rb') as bin_file:
-                    raw_data = bin_file.read()
-                result = chardet.detect(raw_data)
-                encoding = result['encoding']
-                # print(f"Detected encoding: {encoding} (confidence: {result['confidence']})")
-                
-                try:
-                    with open(filepath, 'r', encoding=encoding) as code_file:
-                        code = code_file.read()
-                except UnicodeDecodeError as e:
-                    print(f"Exception reading {os.path.join(root, f)} with encoding {encoding}: {e}")
-                    continue
-              
-                if not has_main_function(code):
-                    continue
-                # TODO check the file for well-formedness (maybe with gcc?)
-                # if the file passes the checks, add it to the dictionary
-                new_entry = {
-                    'repo_name': df_row.name,
-                    'path': os.path.relpath(filepath, os.path.join(DATASET_SRC, repo_folder)),
-                    'stars': int(df_row.Stars),
-                    'repo_size': int(df_row.Size),
-                    'code': code,
-                }
-                dataset_entries.append(new_entry)
-        df.at[df_row.name, 'In_dataset'] = True
-
-    # after everything is done, write to a .jsonl file
-    serialize_to_jsonl(dataset_entries, file_name='dataset.jsonl')
-    wrapup(data=df)
+    # match all folders to df at once to get more data about the repos
+    matches = match_folders_to_rows(folders, df)
+    # skip unmatched repos and those that are already tagged as in dataset
+    tasks = [(repo_folder, row.Repo, int(row.Stars), int(row.Size), dedup != 'off')
+             for repo_folder, row in matches.iterrows() if not row.In_dataset]
+
+    writer = JsonlShardWriter('dataset.jsonl', shard_size=shard_size)
+    # the index persists between runs, so files from repos processed earlier are recognized too
+    dedup_index = DedupIndex() if dedup != 'off' else None
+    duplicates = 0
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    # each result holds the contents of a whole repo
+    results = bounded_map(pool, scan_repo, tasks, jobs * 2) if pool else map(scan_repo, tasks)
+    done = []
+    try:
+        for repo_name, entries, fingerprints in tqdm(results, total=len(tasks)):
+            for i, entry in enumerate(entries):
+                if dedup_index is not None:
+                    content_hash, signature = fingerprints[i]
+                    duplicate = dedup_index.find_duplicate(content_hash, signature, repo_name, entry['path'])
+                    if duplicate is None:
+                        dedup_index.add(content_hash, signature, repo_name, entry['path'])
+                    else:
+                        duplicates += 1
+                        if dedup == 'skip':
+                            continue
+                        entry['duplicate'] = {'type': duplicate[0], 'repo_name': duplicate[1], 'path': duplicate[2]}
+                writer.write(entry)
+            df.at[repo_name, 'In_dataset'] = True
+            done.append(repo_name)
+            # entries are flushed before the flags are saved, so a crash can't mark unwritten repos as done
+            if len(done) >= checkpoint:
+                writer.flush()
+                if dedup_index is not None:
+                    dedup_index.commit()
+                wrapup(data=df, rows=done)
+                done = []
+    finally:
+        writer.close()
+        if dedup_index is not None:
+            dedup_index.close()
+            print(f"{duplicates} duplicate files {'skipped' if dedup == 'skip' else 'tagged'}")
+        wrapup(data=df, rows=done)
+        if pool:
+            pool.shutdown(cancel_futures=True)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=1, help="Number of worker processes scanning repos (default 1)")
+    parser.add_argument('--shard-size', type=float,
+                        help="Split the dataset into shards of at most this many MB (optional)")
+    parser.add_argument('--checkpoint', type=int, default=50,
+                        help="Save the 'In_dataset' flags after this many repos (default 50)")
+    parser.add_argument('--dedup', choices=['skip', 'tag', 'off'], default='skip',
+                        help="Skip files that duplicate files already in the dataset, tag them, "
+                             "or turn off the check (default 'skip')")
+    args = parser.parse_args()
     try:
-        main()
+        main(jobs=args.jobs,
+             shard_size=int(args.shard_size * 1024 * 1024) if args.shard_size else None,
+             checkpoint=args.checkpoint,
+             dedup=args.dedup)
     except EmptyDatasetError as e:
         print(e)
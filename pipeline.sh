@@ -1,36 +1,6 @@
 #!/bin/bash
 
-# exit if a command fails
-set -e
-
-# flag to indicate whether the script is ready to exit
-exit_flag=false
-
-wrapup() {
-    printf "\n*** Process will terminate at the end of the current iteration. ***\n\n"
-    exit_flag=true
-}
-
-trap wrapup SIGTERM
-
-while true; do
-    printf "\n*** Download ***\n\n"
-    python3 -m src.toggler download --q "Last_comp.isna()" --size 100
-    printf "\n*** Compile ***\n\n"
-    python3 -m src.compiler
-    printf "\n*** Archive ***\n\n"
-    python3 -m src.archiver
-    printf "\n *** Clean up ***\n\n"
-    python3 -m src.toggler remove
-
-    if [ "$(ls -A out/source)" ]; then
-        printf "\n*** Exiting because out/source is not empty ***\n"
-        break
-    fi
-
-    rm -rf out/build out/archive
-
-    if [ "$exit_flag" = true ]; then
-        break
-    fi 
-done
+# download, compile, archive and remove repos in overlapping stages until there are none left
+# SIGTERM lets the repos in progress finish before the process exits
+# the source directory has to be empty, otherwise the orchestrator exits right away
+exec python3 -m src.orchestrator --download-jobs 8 --archive-jobs 4 "$@"
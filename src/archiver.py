@@ -1,77 +1,258 @@
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import os
-import shutil
+import struct
+import zipfile
+import zlib
 
 from dotenv import load_dotenv
 import pandas as pd
 from tqdm import tqdm
 
 from .compiler import is_executable
-from .db_handler import initialize, wrapup, match_folder_to_row
+from .db_handler import initialize, wrapup, match_folders_to_rows
+from .filetype import load_cache
 
 load_dotenv()
 SOURCE_DIR = os.path.join(*os.getenv('SOURCE_DIR').split('/'))
 BUILD_DIR = os.path.join(*os.getenv('COMPILE_DIR').split('/'))
 
+SHARD_PREFIX = 'shard-'
+# one JSON line per archived repo: Repo, Commit, shard file, byte range of its members in the shard and member names
+SHARD_INDEX = 'index.jsonl'
 
-def copy_source_files(source: str, target: str):
-    source_path = os.path.join(SOURCE_DIR, source)
-    counter = 0
+
+# members that are already compressed would only get bigger when deflated
+COMPRESSED_EXTENSIONS = {'.gz', '.bz2', '.xz', '.zst', '.zip', '.jar', '.7z', '.png', '.jpg', '.jpeg', '.gif', '.webp'}
+SAMPLE_SIZE = 64 * 1024
+# binaries whose sample doesn't shrink below this ratio are stored, e.g. executables packed with UPX
+STORE_RATIO = 0.95
+# source files are small and compress well, so the slowest level costs little
+TEXT_LEVEL = 9
+BINARY_LEVEL = 6
+# local file header of a zip member (signature, versions, flags, method, time, date, CRC, sizes, name and extra lengths)
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+
+def compression_for(filepath: str, text: bool) -> (int, int | None):
+    """
+    Choose how to compress a file in the archive
+    :param filepath: Path to the file
+    :param text: Whether the file is a source file or README
+    :return: Compression method and level for ZipFile.write
+    """
+    if os.path.splitext(filepath)[1].lower() in COMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED, None
+    if text:
+        return zipfile.ZIP_DEFLATED, TEXT_LEVEL
+    with open(filepath, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    if sample and len(zlib.compress(sample, 1)) > STORE_RATIO * len(sample):
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, BINARY_LEVEL
+
+
+def is_source_file(filename: str) -> bool:
+    file, ext = os.path.splitext(filename)
+    return 'readme' in file.lower() or ext == '.c' or ext == '.h'
+
+
+def add_source_files(zip_file: zipfile.ZipFile, folder: str, prefix: str = '') -> list[str]:
+    """
+    Write the .c/.h files and READMEs of a repo into the archive
+    :param zip_file: Archive opened for writing
+    :param folder: Name of the repo folder in SOURCE_DIR
+    :param prefix: Prepended to the member names, e.g. to keep repos apart in a shard
+    :return: Names of the members added
+    """
+    source_path = os.path.join(SOURCE_DIR, folder)
+    members = []
     for root, _, files in os.walk(source_path):
         for filename in files:
-            file, ext = os.path.splitext(filename)
-            if 'readme' in file.lower() or ext == '.c' or ext == '.h':
-                filepath = os.path.join(root, filename)
-                destination_folder = os.path.join(target, os.path.relpath(root, start=SOURCE_DIR))
-                os.makedirs(destination_folder, exist_ok=True)
-                shutil.copy(filepath, destination_folder)
-                counter += 1
-    print(f"{counter} source files")
-
-
-def copy_build_files(source: str, target: str):
-    source_path = os.path.join(BUILD_DIR, source)
-    counter = 0
+            filepath = os.path.join(root, filename)
+            # symbolic links whose target is missing can't be archived
+            if is_source_file(filename) and os.path.isfile(filepath):
+                arcname = prefix + os.path.relpath(filepath, start=source_path)
+                compress_type, level = compression_for(filepath, text=True)
+                zip_file.write(filepath, arcname, compress_type=compress_type, compresslevel=level)
+                members.append(arcname)
+    print(f"{len(members)} source files")
+    return members
+
+
+def add_build_files(zip_file: zipfile.ZipFile, folder: str, prefix: str = '') -> list[str]:
+    """
+    Write the executables produced by compiling a repo into the archive, next to its source files
+    :param zip_file: Archive opened for writing
+    :param folder: Name of the repo folder in BUILD_DIR
+    :param prefix: Prepended to the member names, e.g. to keep repos apart in a shard
+    :return: Names of the members added
+    """
+    source_path = os.path.join(BUILD_DIR, folder)
+    members = []
     for root, _, files in os.walk(source_path):
         for filename in files:
             filepath = os.path.join(root, filename)
             if is_executable(filepath):
-                destination_folder = os.path.join(target, os.path.relpath(root, start=BUILD_DIR))
-                os.makedirs(destination_folder, exist_ok=True)
-                shutil.copy(filepath, destination_folder)
-                counter += 1
-    print(f"{counter} build files")
+                arcname = prefix + os.path.relpath(filepath, start=source_path)
+                compress_type, level = compression_for(filepath, text=False)
+                zip_file.write(filepath, arcname, compress_type=compress_type, compresslevel=level)
+                members.append(arcname)
+    print(f"{len(members)} build files")
+    return members
+
+
+def archive_repo(folder: str, zip_dir: str) -> bool:
+    """
+    Write the source files and executables of a repo straight into its zip archive
+    The archive is written under a temporary name, so an interrupted run never leaves a partial zip behind
+    :param folder: Name of the repo folder in SOURCE_DIR and BUILD_DIR
+    :param zip_dir: Directory to save zip files
+    :return: True if the archive was created
+    """
+    print(f"Archiving {folder}...")
+    zip_path = os.path.join(zip_dir, f"{folder}.zip")
+    tmp_path = zip_path + '.tmp'
+    try:
+        # strict_timestamps=False clamps files dated before 1980 instead of failing
+        with zipfile.ZipFile(tmp_path, 'w', strict_timestamps=False) as zip_file:
+            add_source_files(zip_file, folder)
+            add_build_files(zip_file, folder)
+    # a file was removed while the repo was being archived
+    except FileNotFoundError as e:
+        print(e)
+        os.remove(tmp_path)
+        print("Archive cleaned up")
+        return False
+    os.replace(tmp_path, zip_path)
+    return True
 
 
-def folders_to_zip(source: str, target: str, df: pd.DataFrame):
+def estimate_size(folder: str) -> int:
     """
-    Compress each folder in a directory to a zip archive and updated the 'Archived' flag in the dataframe
-    :param source: Directory containing folders to be zipped
-    :param target: Directory to save zip files
-    :param df: Dataframe
+    Upper bound of the uncompressed size of a repo's archive members, used to fill shards
+    :param folder: Name of the repo folder in SOURCE_DIR and BUILD_DIR
+    :return: Size in bytes
     """
-    archives = [x for x in os.scandir(source) if x.is_dir()]
-    for entry in archives:
-        row_found = match_folder_to_row(entry.name, df)
-        if row_found is None:
-            continue
-        zip_path = os.path.join(target, f"{entry.name}.zip")
-        shutil.make_archive(zip_path[:-4], 'zip', entry.path)
-        df.at[row_found.name, 'Archived'] = True
+    size = 0
+    for base, source in ((SOURCE_DIR, True), (BUILD_DIR, False)):
+        for root, _, files in os.walk(os.path.join(base, folder)):
+            for filename in files:
+                if not source or is_source_file(filename):
+                    try:
+                        size += os.path.getsize(os.path.join(root, filename))
+                    except OSError:
+                        pass
+    return size
 
 
-def is_archivable(repo_dir_name: str, df: pd.DataFrame) -> bool:
+def plan_shards(folders: list[str], shard_size: int) -> list[list[str]]:
+    """
+    Group repos into shards of up to shard_size bytes (before compression), a bigger repo gets a shard of its own
+    :param folders: Names of the repo folders to archive
+    :param shard_size: Target shard size in bytes
+    :return: List of repo folders per shard
+    """
+    shards = []
+    current, current_size = [], 0
+    for folder in folders:
+        size = estimate_size(folder)
+        if current and current_size + size > shard_size:
+            shards.append(current)
+            current, current_size = [], 0
+        current.append(folder)
+        current_size += size
+    if current:
+        shards.append(current)
+    return shards
+
+
+def next_shard_number(zip_dir: str) -> int:
+    numbers = [int(name[len(SHARD_PREFIX):-len('.zip')]) for name in os.listdir(zip_dir)
+               if name.startswith(SHARD_PREFIX) and name.endswith('.zip')]
+    return max(numbers, default=-1) + 1
+
+
+def _member_end(f, info: zipfile.ZipInfo) -> int:
+    """
+    :param f: Zip file opened for reading in binary mode
+    :param info: Member of the zip file
+    :return: Offset of the first byte after the member's header and data
+    """
+    f.seek(info.header_offset)
+    header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+    end = info.header_offset + LOCAL_HEADER.size + header[-2] + header[-1] + info.compress_size
+    if info.flag_bits & 0x08:
+        # data descriptor after the data: signature, CRC and sizes (sizes of 8 bytes with ZIP64)
+        end += 24 if info.compress_size >= 0xFFFFFFFF or info.file_size >= 0xFFFFFFFF else 16
+    return end
+
+
+def archive_shard(task: tuple[str, list[str]], zip_dir: str) -> list[dict]:
+    """
+    Write the source files and executables of several repos into one zip shard, each repo under its folder name
+    Members of a repo are written one after another, so they occupy a single byte range of the shard
+    If a repo can't be archived, the shard is written again without it, so it contains no unindexed members
+    :param task: Shard file name and the repo folders it holds
+    :param zip_dir: Directory to save shards
+    :return: Index entries of the repos that were archived, with the shard, byte range and member names
+    """
+    shard_name, folders = task
+    shard_path = os.path.join(zip_dir, shard_name)
+    tmp_path = shard_path + '.tmp'
+    written = []  # repo folder, member names and position of its first member in the shard
+    failed = None
+    with zipfile.ZipFile(tmp_path, 'w', strict_timestamps=False) as zip_file:
+        for folder in folders:
+            print(f"Archiving {folder} to {shard_name}...")
+            first = len(zip_file.infolist())
+            try:
+                members = add_source_files(zip_file, folder, prefix=folder + '/')
+                members += add_build_files(zip_file, folder, prefix=folder + '/')
+            # a file was removed while the repo was being archived
+            except FileNotFoundError as e:
+                print(e)
+                failed = folder
+                break
+            written.append((folder, members, first))
+    if failed is not None:
+        os.remove(tmp_path)
+        remaining = [folder for folder in folders if folder != failed]
+        return archive_shard((shard_name, remaining), zip_dir) if remaining else []
+
+    # byte ranges from the local headers of the first and last member of every repo
+    entries = []
+    with zipfile.ZipFile(tmp_path) as zip_file, open(tmp_path, 'rb') as f:
+        infos = zip_file.infolist()
+        for folder, members, first in written:
+            offset = infos[first].header_offset if members else 0
+            end = _member_end(f, infos[first + len(members) - 1]) if members else 0
+            entries.append({
+                'folder': folder,
+                'shard': shard_name,
+                'offset': offset,
+                'length': end - offset,
+                'members': members,
+            })
+    os.replace(tmp_path, shard_path)
+    return entries
+
+
+def is_archivable(repo_dir_name: str, matches: pd.DataFrame) -> bool:
     """
     Check if the repo fulfills the requirements to be archived:
     - Can be matched to the repo database
     - Compilation output has produced executable files
     - Source repo is currently on disk
     :param repo_dir_name: Name of the directory where the repo source (or build) is stored
-    :param df: Dataframe with all repo data
+    :param matches: Rows matched to the repo directories, as returned by match_folders_to_rows
     :return: True or False
     """
-    row_found = match_folder_to_row(repo_dir_name, df)
-    if row_found is None:
+    if repo_dir_name not in matches.index:
         return False
+    row_found = matches.loc[repo_dir_name]
     if pd.isna(row_found['Execs']) or row_found['Execs'] == '':
         print("No executables!")
         return False
@@ -81,41 +262,65 @@ def is_archivable(repo_dir_name: str, df: pd.DataFrame) -> bool:
     return True
 
 
-def process_repo(repo_dir: os.DirEntry, arch_dir: str):
-    try:
-        copy_source_files(repo_dir.name, arch_dir)
-        copy_build_files(repo_dir.name, arch_dir)
-    # TODO this happens with symbolic links, need to look into it
-    except FileNotFoundError as e:
-        print(e)
-        # clean up the archival directory for this repo if it was already created
-        try:
-            shutil.rmtree(os.path.join(arch_dir, repo_dir.name))
-            print("Archive directory cleaned up")
-        except FileNotFoundError:
-            pass
-            print("No archive directory was created")
-
-
-def main():
+def main(jobs: int = 1, shard_size: int = None):
+    """
+    :param jobs: Number of repos (or shards) to archive concurrently (default 1 archives them one after another)
+    :param shard_size: Pack repos into shards of about this many bytes before compression with an index
+    (optional, one zip per repo if not provided)
+    """
     df, _ = initialize()
-    arch_dir = os.path.join('out', 'archive')
+    # reuse file classifications made by Compiler
+    load_cache()
     zip_dir = os.path.join('out', 'zip')
-
-    os.makedirs(arch_dir, exist_ok=True)
     os.makedirs(zip_dir, exist_ok=True)
 
     repos = [x for x in os.scandir(BUILD_DIR) if x.is_dir()]
-    for entry in tqdm(repos):
-        print()
-        print(f"Processing {entry.name}...")
-        if is_archivable(entry.name, df):
-            process_repo(entry, arch_dir)
+    # resolve all repo folders at once instead of searching the dataframe for each of them
+    matches = match_folders_to_rows([entry.name for entry in repos], df)
+    folders = []
+    for entry in repos:
+        print(f"Checking {entry.name}...")
+        if is_archivable(entry.name, matches):
+            folders.append(entry.name)
+
+    if shard_size:
+        first = next_shard_number(zip_dir)
+        tasks = [(f"{SHARD_PREFIX}{first + i:05d}.zip", shard)
+                 for i, shard in enumerate(plan_shards(folders, shard_size))]
+        archive = partial(archive_shard, zip_dir=zip_dir)
+    else:
+        tasks = folders
+        archive = partial(archive_repo, zip_dir=zip_dir)
+
+    if jobs > 1:
+        # compression is CPU-bound, so every repo (or shard) is archived in its own process
+        with ProcessPoolExecutor(max_workers=jobs, initializer=load_cache) as pool:
+            results = list(tqdm(pool.map(archive, tasks), total=len(tasks)))
+    else:
+        results = [archive(task) for task in tqdm(tasks)]
 
-    # TODO fails when there are no execs because out/archive doesn't exist
-    folders_to_zip(arch_dir, zip_dir, df)
-    wrapup(data=df)
+    archived_before = df['Archived'].copy()
+    if shard_size:
+        with open(os.path.join(zip_dir, SHARD_INDEX), 'a', encoding='utf-8') as index_file:
+            for entry in (entry for entries in results for entry in entries):
+                repo = matches.at[entry['folder'], 'Repo']
+                commit = matches.at[entry['folder'], 'Commit']
+                index_file.write(json.dumps({'repo': repo, 'commit': None if pd.isna(commit) else commit,
+                                             **entry}) + '\n')
+                df.at[repo, 'Archived'] = True
+    else:
+        for folder, archived in zip(folders, results):
+            if archived:
+                df.at[matches.at[folder, 'Repo'], 'Archived'] = True
+    wrapup(data=df, rows=df.index[df['Archived'] != archived_before])
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of repos to archive concurrently in separate worker processes (default 1)")
+    parser.add_argument('--shard-size', type=int,
+                        help="Pack repos into zip shards of about this many MB of files (before compression) "
+                             f"listed in {SHARD_INDEX}, instead of writing one zip per repo")
+    args = parser.parse_args()
+    main(jobs=args.jobs, shard_size=args.shard_size * 1024 * 1024 if args.shard_size else None)
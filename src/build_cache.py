@@ -0,0 +1,153 @@
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CACHE_DIR = os.path.join(*os.getenv('BUILD_CACHE_DIR', 'out/cache').split('/'))
+CACHE_SIZE = float(os.getenv('BUILD_CACHE_SIZE', 10240))  # max size of the build cache in MB
+META_FILE = 'meta.json'
+FILES_DIR = 'files'
+
+# environment variables that change the output of a build
+FLAG_VARS = ['CC', 'CFLAGS', 'CPPFLAGS', 'LDFLAGS', 'LDLIBS', 'MAKEFLAGS']
+
+
+@functools.cache
+def toolchain_versions() -> dict[str, str]:
+    """
+    First line of the version output of every build tool, computed once per process
+    """
+    versions = {}
+    for tool in ['gcc', 'cmake', 'make', 'autoconf', 'meson', 'ninja']:
+        try:
+            out = subprocess.run([tool, '--version'], capture_output=True, text=True, timeout=10).stdout
+            versions[tool] = out.split('\n', 1)[0]
+        except (OSError, subprocess.TimeoutExpired):
+            versions[tool] = ''
+    return versions
+
+
+def cache_key(repo: str, commit: str, build_system: str, build_target: str) -> str:
+    """
+    :param repo: Full name of the repo ('owner/repo')
+    :param commit: Commit hash of the downloaded repo state
+    :param build_system: Build system chosen for the repo ('cmake', 'meson', 'autotools', 'make', 'gcc')
+    :param build_target: Build file or directory the build was started from (relative to the repo root)
+    :return: Hex digest identifying the build
+    """
+    key = {
+        'repo': repo,
+        'commit': commit,
+        'build_system': build_system,
+        'build_target': build_target,
+        'toolchain': toolchain_versions(),
+        'flags': {var: os.getenv(var, '') for var in FLAG_VARS},
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def link_or_copy(src: str, dst: str):
+    """
+    Copy function for shutil.copytree that makes hard links where possible
+    """
+    # hard links don't take up extra space, fall back to copying across file systems
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def restore(key: str, target: str) -> dict | None:
+    """
+    Restore the build files of a cached build
+    :param key: Cache key
+    :param target: Directory where the build files should be placed
+    :return: Metadata of the cached build, or None if the key is not in the cache
+    """
+    entry = os.path.join(CACHE_DIR, key)
+    meta_path = os.path.join(entry, META_FILE)
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path, 'rt', encoding='utf-8') as f:
+        meta = json.load(f)
+    # replace the output of an earlier build, copying over it fails if it consists of links to the same cached files
+    # (SameFileError), and files the cached build doesn't have would be left behind
+    shutil.rmtree(target, ignore_errors=True)
+    files = os.path.join(entry, FILES_DIR)
+    if os.path.isdir(files):
+        shutil.copytree(files, target, symlinks=True, copy_function=link_or_copy)
+    # the modification time of the metadata file marks when the entry was last used
+    os.utime(meta_path)
+    return meta
+
+
+def store(key: str, source: str, meta: dict):
+    """
+    Add a build to the cache, the size limit is enforced by evict()
+    :param key: Cache key
+    :param source: Directory with the build files
+    :param meta: Build metadata to restore along with the files (must be JSON serializable)
+    """
+    entry = os.path.join(CACHE_DIR, key)
+    tmp_entry = f"{entry}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_entry, ignore_errors=True)
+    os.makedirs(tmp_entry)
+    if os.path.isdir(source):
+        shutil.copytree(source, os.path.join(tmp_entry, FILES_DIR), symlinks=True, copy_function=link_or_copy)
+    meta = dict(meta, size=_dir_size(tmp_entry))
+    with open(os.path.join(tmp_entry, META_FILE), 'wt', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+    # replace the entry in one step so that a concurrent restore never sees it half written
+    shutil.rmtree(entry, ignore_errors=True)
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # another worker has stored the same build in the meantime
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+
+def evict(limit_mb: float = CACHE_SIZE):
+    """
+    Remove least recently used builds until the cache fits the size limit
+    It reads the metadata of every build, so it runs once per run or at an interval
+    """
+    if not os.path.isdir(CACHE_DIR):
+        return
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        meta_path = os.path.join(entry.path, META_FILE)
+        if not entry.is_dir() or not os.path.isfile(meta_path):
+            continue
+        try:
+            with open(meta_path, 'rt', encoding='utf-8') as f:
+                size = json.load(f).get('size', 0)
+            entries.append((os.path.getmtime(meta_path), size, entry.path))
+        except (OSError, ValueError):
+            continue
+
+    total = sum(size for _, size, _ in entries)
+    limit = limit_mb * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        print(f"Evicted {os.path.basename(path)} from build cache")
@@ -0,0 +1,105 @@
+import os
+
+# build systems in order of preference when several are found on the same level of the repo
+BUILD_SYSTEMS = ['cmake', 'meson', 'autotools', 'make']
+# file names that mark a build system
+BUILD_FILES = {
+    'CMakeLists.txt': 'cmake',
+    'meson.build': 'meson',
+    'configure': 'autotools',
+    'configure.ac': 'autotools',
+    'configure.in': 'autotools',
+    'Makefile': 'make',
+    'makefile': 'make',
+    'GNUmakefile': 'make',
+}
+# directories that rarely contain the main build, only visited if the rest of the repo has nothing to build
+PRUNED_DIRS = {
+    '.git', '.github', '.svn', '.hg', 'cmakefiles',
+    'test', 'tests', 'testing', 'unittest', 'unittests',
+    'third_party', 'thirdparty', '3rdparty', 'vendor', 'external', 'extern',
+    'doc', 'docs',
+}
+KEYWORD_PRIORITY = {
+    'src': 2,
+    'source': 2,
+    'scripts': 1,
+    'app': 1,
+    'program': 1,
+}
+
+
+def assign_priority_score(root_path: str, file_path: str) -> (int, int):
+    """
+    :param root_path: Root directory of the repository
+    :param file_path: Path to a build file in the repository
+    :return: Priority of the most promising directory name on the way to the file and its negative depth,
+    higher is better
+    """
+    rel_dir = os.path.relpath(os.path.dirname(file_path), root_path)
+    dirs = [] if rel_dir == os.curdir else rel_dir.split(os.sep)
+    priority = max((KEYWORD_PRIORITY.get(name.lower(), 0) for name in dirs), default=0)
+    return priority, -len(dirs)
+
+
+def build_target(build_system: str, file_path: str) -> str:
+    """
+    :return: Path to CMakeLists.txt for cmake, the directory of the build file for everything else
+    """
+    return file_path if build_system == 'cmake' else os.path.dirname(file_path)
+
+
+def scan_repo(repo_path: str) -> (list[tuple[str, str]], list[str]):
+    """
+    Find the build files closest to the repo root in a single breadth-first walk
+    The walk stops after the first level that contains a build file, so deeper directories are never listed
+    Directories in PRUNED_DIRS are only walked if the rest of the repo has neither build files nor .c files
+    :param repo_path: Root directory of the repository (full path, relative to cwd)
+    :return: Build candidates as (build system, target) tuples, best first, see build_target,
+    and the .c files if there are no candidates (sorted, empty otherwise)
+    """
+    level = [repo_path]
+    deferred = []
+    cfiles = []
+    while level or (deferred and not cfiles):
+        if not level:
+            level, deferred = deferred, []
+        found = []
+        next_level = []
+        for directory in level:
+            try:
+                with os.scandir(directory) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        (deferred if entry.name.lower() in PRUNED_DIRS else next_level).append(entry.path)
+                    elif entry.name in BUILD_FILES and entry.is_file():
+                        found.append((BUILD_FILES[entry.name], entry.path))
+                    elif entry.name.endswith('.c') and entry.is_file():
+                        cfiles.append(entry.path)
+                except OSError:
+                    continue
+        if found:
+            return rank_candidates(repo_path, found), []
+        level = next_level
+    return [], sorted(cfiles)
+
+
+def rank_candidates(repo_path: str, found: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    """
+    :param repo_path: Root directory of the repository
+    :param found: Build systems and paths of their build files
+    :return: Unique (build system, target) tuples, ordered by BUILD_SYSTEMS and then by assign_priority_score
+    """
+    found.sort(key=lambda item: (BUILD_SYSTEMS.index(item[0]),
+                                 [-score for score in assign_priority_score(repo_path, item[1])],
+                                 item[1]))
+    candidates = []
+    for build_system, file_path in found:
+        candidate = (build_system, build_target(build_system, file_path))
+        if candidate not in candidates:
+            candidates.append(candidate)
+    return candidates
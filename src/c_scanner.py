@@ -0,0 +1,137 @@
+import re
+
+# one alternative per token kind, tried in order at the current position
+# comments, strings and char literals are matched as a whole so that their contents are never mistaken for code
+# every pattern can end anywhere (closing quotes are optional), so a failed match never backtracks over a long line
+TOKEN_PATTERN = re.compile(r'''
+    (?P<newline>\n)
+  | (?P<space>(?:[ \t\r\f\v]|\\\r?\n)+)
+  | (?P<block_comment>/\*.*?(?:\*/|\Z))
+  | (?P<line_comment>//(?:[^\n\\]+|\\.)*)
+  | (?P<directive>\#(?:[^\n\\]+|\\.|\\\n)*)
+  | (?P<string>"(?:[^"\\\n]+|\\.|\\\n)*"?)
+  | (?P<char>'(?:[^'\\\n]+|\\.)*'?)
+  | (?P<ident>[A-Za-z_]\w*)
+  | (?P<number>\.?\d(?:[eEpP][+-]|[\w.])*)
+  | (?P<punct>.)
+''', re.VERBOSE | re.DOTALL)
+INCLUDE_PATTERN = re.compile(r'#\s*include\s*[<"]([^>"]+)[>"]')
+SKIPPED_TOKENS = {'newline', 'space', 'block_comment', 'line_comment'}
+# extensions that can follow the parameter list of a definition, their arguments in parentheses are skipped
+ATTRIBUTE_KEYWORDS = {'__attribute__', '__attribute', '__declspec', '__asm__', '__asm', 'asm'}
+
+
+def iter_tokens(code: str):
+    """
+    Split C code into tokens in a single pass, skipping whitespace and comments
+    Preprocessor lines (including continuation lines) are returned as a single 'directive' token
+    :param code: C source code
+    :return: Generator of (kind, text) tuples, kind is one of
+    'directive', 'string', 'char', 'ident', 'number', 'punct'
+    """
+    pos = 0
+    at_line_start = True
+    length = len(code)
+    while pos < length:
+        match = TOKEN_PATTERN.match(code, pos)
+        kind = match.lastgroup
+        end = match.end()
+        if kind == 'directive' and not at_line_start:
+            # '#' in the middle of a line is not a preprocessor directive
+            kind, end = 'punct', pos + 1
+        if kind == 'newline':
+            at_line_start = True
+        elif kind not in SKIPPED_TOKENS:
+            at_line_start = False
+        if kind not in SKIPPED_TOKENS:
+            yield kind, code[pos:end]
+        pos = end
+
+
+def scan_c_source(code: str) -> dict:
+    """
+    Collect cheap features of C code in a single pass over its tokens
+    A function definition is an identifier at file scope followed by a parameter list and a body,
+    old-style (K&R) parameter declarations and attributes (__attribute__, __declspec, __asm__)
+    between the list and the body are allowed
+    :param code: C source code
+    :return: Dictionary with 'has_main' (bool), 'lines' (int), 'includes' (list of included headers)
+    and 'functions' (number of function definitions)
+    """
+    features = {
+        'has_main': False,
+        'lines': code.count('\n') + (1 if code and not code.endswith('\n') else 0),
+        'includes': [],
+        'functions': 0,
+    }
+
+    brace_depth = 0
+    paren_depth = 0
+    last_ident = None  # identifier directly before the current token
+    candidate = None  # name of a possible function whose parameter list is being read
+    after_params = None  # name of a possible function whose parameter list has just been closed
+    in_knr = False  # reading old-style parameter declarations between the parameter list and the body
+    in_attribute = False  # an attribute keyword after the parameter list, its arguments come next
+    attribute_depth = 0  # depth of the parentheses of the attribute arguments being skipped
+
+    for kind, text in iter_tokens(code):
+        if kind == 'directive':
+            include = INCLUDE_PATTERN.match(text)
+            if include:
+                features['includes'].append(include.group(1))
+            continue
+
+        if after_params is not None and (in_attribute or attribute_depth):
+            if text == '(':
+                attribute_depth += 1
+                continue
+            if attribute_depth:
+                if text == ')':
+                    attribute_depth -= 1
+                continue
+            # a keyword without arguments
+            in_attribute = False
+
+        if after_params is not None:
+            if kind == 'ident' and text in ATTRIBUTE_KEYWORDS:
+                in_attribute = True
+                continue
+            if text == '{':
+                features['functions'] += 1
+                if after_params == 'main':
+                    features['has_main'] = True
+                after_params = None
+            elif not in_knr:
+                # anything but a body or a type name means this was a prototype or a declaration
+                if kind == 'ident':
+                    in_knr = True
+                else:
+                    after_params = None
+            elif text in ('(', ')', '=', '}'):
+                after_params = None
+
+        if text == '{':
+            brace_depth += 1
+        elif text == '}':
+            brace_depth = max(brace_depth - 1, 0)
+        elif brace_depth == 0 and text == '(':
+            if paren_depth == 0:
+                candidate = last_ident
+            paren_depth += 1
+        elif brace_depth == 0 and text == ')':
+            paren_depth = max(paren_depth - 1, 0)
+            if paren_depth == 0 and candidate is not None:
+                after_params, candidate, in_knr = candidate, None, False
+
+        last_ident = text if kind == 'ident' else None
+    return features
+
+
+def has_main_function(code: str) -> bool:
+    """
+    Check whether given C code contains a main() function definition
+    Comments, string and char literals and preprocessor lines are ignored
+    :param code: Code to check in string format, newlines included
+    :return: True or False
+    """
+    return scan_c_source(code)['has_main']
@@ -1,15 +1,31 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import csv
 from datetime import datetime
+import functools
+import hashlib
 import os
+import resource
+import shlex
 import shutil
 import signal
 import subprocess
+import sys
+import tempfile
+import time
 
 from dotenv import load_dotenv
+import pandas as pd
 from tqdm import tqdm
 
+from . import build_cache, compiler_cache, object_cache
+from .build_scanner import scan_repo
+from .c_scanner import scan_c_source
+from .compiler_cache import MODES as COMPILER_CACHE_MODES
 from .db_handler import initialize, wrapup
+from .filetype import compact_cache, get_file_type, is_executable_type, move_cached, save_cache
+from .sandbox import SANDBOX_DIR, MODES as SANDBOX_MODES, Sandbox
+from .snapshot import start_tracking
 from .toggler import execute_command
 
 load_dotenv()
@@ -19,18 +35,46 @@ SOURCE_DIR = os.path.join(*os.getenv('SOURCE_DIR').split('/'))
 BUILD_DIR = os.path.join(*os.getenv('COMPILE_DIR').split('/'))
 LOG_DIR = os.path.join('out', 'logs')
 
-V_FLAG = False  # verbosity setting
+# limits for every build command, 0 turns a limit off
+BUILD_TIMEOUT = int(os.getenv('BUILD_TIMEOUT', 180))  # wall-clock seconds
+MEMORY_LIMIT = int(os.getenv('BUILD_MEMORY_LIMIT', 4096))  # MB of address space per process
+CPU_LIMIT = int(os.getenv('BUILD_CPU_LIMIT', 600))  # CPU seconds per process
+# processes of the whole user (not only the build), ignored for root
+PROCESS_LIMIT = int(os.getenv('BUILD_PROCESS_LIMIT', 4096))
+FILE_SIZE_LIMIT = int(os.getenv('BUILD_FILE_SIZE_LIMIT', 1024))  # MB per written file
+# starts build commands and reports their resource usage
+LAUNCHER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'launcher.py')
+MB = 1024 * 1024
+# resource usage of a build saved to the database, in seconds and KB for Max_rss
+USAGE_COLUMNS = ['Cpu_user', 'Cpu_sys', 'Max_rss', 'Wall_time']
+# CPUs shared by all builds that run at the same time, each build gets an equal share for its parallel jobs
+CPU_BUDGET = int(os.getenv('BUILD_CPUS', 0)) or os.cpu_count() or 1
 
-def run_cmake(cmake_path: str, repo_path: str) -> (str, str, str):
+V_FLAG = False  # verbosity setting
+BUILD_JOBS = 1  # parallel jobs of a single build (make -j), see jobs_per_build
+# tools a build system needs, repos with several build files are built with one whose tools are installed
+BUILD_TOOLS = {
+    'cmake': ['cmake'],
+    'meson': ['meson', 'ninja'],
+    'autotools': ['make'],
+    'make': ['make'],
+    'gcc': ['gcc'],
+}
+
+def run_cmake(cmake_path: str, repo_path: str, sandbox: Sandbox = None, usage: dict = None,
+              env: dict = None) -> (str, str, str):
     """
     :param cmake_path: Path to the CMakeLists.txt file (relative to cwd)
     :param repo_path: Root directory of the repository (full path, relative to cwd)
+    :param sandbox: Sandbox to run the build in (optional)
+    :param usage: Resource usage of the build, updated in place (optional)
+    :param env: Environment of the build commands, e.g. to call the compilers through the compiler cache (optional)
     :return: executed command(s), list of target files, stdout, stderr
     """
     out_log = ''
     err_log = ''
 
-    # create build folder if it doesn't exist
+    # build folder, cmake creates it if it doesn't exist
     build_rel = 'build'  # relative to the repo root
     build_path = os.path.join(repo_path, build_rel)
     # make sure there's no file with this name
@@ -39,7 +83,6 @@ def run_cmake(cmake_path: str, repo_path: str) -> (str, str, str):
         build_rel += str(suffix)
         build_path = os.path.join(repo_path, build_rel)
         suffix += 1
-    os.makedirs(build_path, exist_ok=True)
 
     # remove file name from the CMakeLists path
     cmake_dir = os.path.dirname(cmake_path)
@@ -49,7 +92,7 @@ def run_cmake(cmake_path: str, repo_path: str) -> (str, str, str):
 
     print(f"Run cmake: {cmake_dir}")
     command = ['cmake', '-S', source_rel, '-B', build_rel]
-    returncode, out, err = run_subprocess(command, repo_path, v=V_FLAG)
+    returncode, out, err = run_subprocess(command, repo_path, v=V_FLAG, sandbox=sandbox, usage=usage, env=env)
 
     # logging
     process_log = 'cmake'
@@ -59,8 +102,8 @@ def run_cmake(cmake_path: str, repo_path: str) -> (str, str, str):
     # TODO does it make sense to continue if return code is not 0? (generates additional string junk)
 
     # build
-    command = ['cmake', '--build', build_rel]
-    _, out, err = run_subprocess(command, repo_path, v=V_FLAG)
+    command = ['cmake', '--build', build_rel, '--parallel', str(BUILD_JOBS)]
+    _, out, err = run_subprocess(command, repo_path, v=V_FLAG, sandbox=sandbox, usage=usage, env=env)
 
     # logging
     process_log = 'cmake --build'
@@ -74,168 +117,388 @@ def run_cmake(cmake_path: str, repo_path: str) -> (str, str, str):
     return process_log, out_log, err_log
 
 
-def run_make(make_path: str) -> (str, str, str):
+def run_make(make_path: str, sandbox: Sandbox = None, usage: dict = None, env: dict = None) -> (str, str, str):
     """
     :param make_path: Directory where Makefile is located or will be generated (full path, relative to cwd)
+    :param sandbox: Sandbox to run the build in (optional)
+    :param usage: Resource usage of the build, updated in place (optional)
+    :param env: Environment of the build commands, e.g. to call the compilers through the compiler cache (optional)
     :return: executed command(s), list of target files, stdout, stderr
     """
     print(f"Run make: {make_path}")
-    command = ['make', 'V=1']
-    _, out, err = run_subprocess(command, make_path, v=V_FLAG)
+    command = ['make', f'-j{BUILD_JOBS}', 'V=1']
+    _, out, err = run_subprocess(command, make_path, v=V_FLAG, sandbox=sandbox, usage=usage, env=env)
     return command[0], out, err
 
 
-def run_gcc(repo_path: str, cfiles: list) -> (str, str, str):
+def run_autotools(source_path: str, sandbox: Sandbox = None, usage: dict = None,
+                  env: dict = None) -> (str, str, str):
     """
-    :param repo_path: Path to the repository root
-    :param cfiles: List of paths to all .c files in the repo
-    :return: executed command, list of target files, stdout, stderr
+    Generate the configure script if the repo doesn't ship one, then run it and make in the source directory
+    :param source_path: Directory with the configure script or configure.ac (full path, relative to cwd)
+    :param sandbox: Sandbox to run the build in (optional)
+    :param usage: Resource usage of the build, updated in place (optional)
+    :param env: Environment of the build commands, e.g. to call the compilers through the compiler cache (optional)
+    :return: executed command(s), stdout, stderr
     """
-    output_file = 'compiled_output'
-    cfiles_relative = [os.path.relpath(f, repo_path) for f in cfiles]
-    print(f"Run gcc: {repo_path}")
-    command = ['gcc'] + cfiles_relative + ['-o', output_file]
-    _, out, err = run_subprocess(command, repo_path, v=V_FLAG)
-    return command[0], out, err
+    print(f"Run autotools: {source_path}")
+    steps = []
+    # scripts are called through sh, downloaded repos don't keep the executable bit
+    if not os.path.isfile(os.path.join(source_path, 'configure')):
+        if os.path.isfile(os.path.join(source_path, 'autogen.sh')):
+            # NOCONFIGURE is the usual way to stop autogen.sh from running configure itself
+            steps.append(('autogen.sh', ['env', 'NOCONFIGURE=1', 'sh', 'autogen.sh']))
+        else:
+            steps.append(('autoreconf', ['autoreconf', '--install', '--force']))
+    steps.append(('configure', ['sh', './configure']))
+    steps.append(('make', ['make', f'-j{BUILD_JOBS}', 'V=1']))
+    return run_steps(steps, source_path, sandbox, usage, env)
 
 
-def run_subprocess(command: list, cwd: str, v: bool = False) -> (int, str, str):
+def run_meson(source_path: str, sandbox: Sandbox = None, usage: dict = None, env: dict = None) -> (str, str, str):
     """
-    :param command:
-    :param cwd:
-    :param v: Verbosity (default False)
-    :return: subprocess return code, stdout and stderr
+    Configure the project with meson in a new build directory and build it with ninja
+    :param source_path: Directory with the top-level meson.build (full path, relative to cwd)
+    :param sandbox: Sandbox to run the build in (optional)
+    :param usage: Resource usage of the build, updated in place (optional)
+    :param env: Environment of the build commands, e.g. to call the compilers through the compiler cache (optional)
+    :return: executed command(s), stdout, stderr
     """
-    process = subprocess.Popen(command,
-                               cwd=cwd,
-                               start_new_session=True,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               text=True)
-
-    try:
-        stdout, stderr = process.communicate(timeout=180)
-        if v:
-            if stdout:
-                print(f"\nSTDOUT:\n{stdout}")
-            if stderr:
-                print(f"\nSTDERR:\n{stderr}")
-        return process.returncode, stdout, stderr
-    except subprocess.TimeoutExpired as e:
-        os.killpg(os.getpgid(process.pid), signal.SIGTERM)  # terminate the whole process group
-        print("Timeout")
-        # attempt to get any output after killing the process
-        try:
-            stdout, stderr = process.communicate(timeout=10)  # get any output after killing
-        except subprocess.TimeoutExpired:
-            stdout, stderr = None, "Timeout"
-        if v:
-            if stdout:
-                print(f"\nSTDOUT:\n\n{stdout}")
-            if stderr:
-                print(f"\nSTDERR:\n\n{stderr}")
-        return None, stdout, stderr
-    except Exception as e:
-        print(e)
-        return None, "", str(e)
-
-
-# TODO return dict instead + add .a and .so files
-# TODO check traversal
-def get_relevant_files(root_path: str) -> (list, list, list):
-    makefiles = []
-    cmakelists = []
-    cfiles = []
-    
-    # print(f'Walk subdirs: {root_path}')
-    # TODO stop checking for other types once a higher-priority type is found
-    for root, _, files in os.walk(root_path):
-        for f in files:
-            if f.endswith('.c'):
-                cfiles.append(os.path.join(root, f))
-            elif f == 'Makefile':
-                score = assign_priority_score(root, f)
-                makefiles.append((os.path.join(root, f), *score))
-            elif f == 'CMakeLists.txt':
-                score = assign_priority_score(root, f)
-                cmakelists.append((os.path.join(root, f), *score))
-    return makefiles, cmakelists, cfiles
-
-
-def assign_priority_score(root_path: str, file_path: str) -> (int, int):
-    priority = 0
-    keyword_priority = {
-        'src': 2,
-        'source': 2,
-        'scripts': 1,
-        'app': 1,
-        'program': 1,
-    }
+    # meson refuses to reuse a directory that isn't one of its build directories
+    build_rel = 'build-meson'
+    suffix = 0
+    while os.path.exists(os.path.join(source_path, build_rel)):
+        build_rel = f'build-meson{suffix}'
+        suffix += 1
 
-    for keyword, level in keyword_priority.items():
-        if keyword in file_path:
-            priority = level
-            break
+    print(f"Run meson: {source_path}")
+    steps = [
+        ('meson setup', ['meson', 'setup', build_rel]),
+        ('ninja', ['ninja', '-C', build_rel, '-j', str(BUILD_JOBS), '-v']),
+    ]
+    return run_steps(steps, source_path, sandbox, usage, env)
 
-    depth = abs(len(os.path.relpath(file_path, root_path).split(os.sep)) - 1)
 
-    return priority, -depth
+def run_steps(steps: list[tuple[str, list[str]]], cwd: str, sandbox: Sandbox = None, usage: dict = None,
+              env: dict = None) -> (str, str, str):
+    """
+    Run build commands one after another, stopping at the first one that fails
+    :param steps: Name for the log and command of every step
+    :param cwd: Directory to run the commands in
+    :param sandbox: Sandbox to run the build in (optional)
+    :param usage: Resource usage of the build, updated in place (optional)
+    :param env: Environment of the build commands, e.g. to call the compilers through the compiler cache (optional)
+    :return: name of the last executed step, stdout and stderr of all steps
+    """
+    process_log = ''
+    out_log = []
+    err_log = []
+    for name, command in steps:
+        returncode, out, err = run_subprocess(command, cwd, v=V_FLAG, sandbox=sandbox, usage=usage, env=env)
+        process_log = name
+        out_log.append(out)
+        err_log.append(err)
+        if returncode != 0:
+            break
+    return process_log, '\n\n'.join(filter(None, out_log)), '\n\n'.join(filter(None, err_log))
 
 
-def find_best_file(file_list: list) -> str:
-    file_list.sort(key=lambda x: (x[1], x[2]), reverse=True)
-    return file_list[0][0]
+def find_include_dirs(repo_path: str, units: list[dict]) -> list[str]:
+    """
+    Find the directories that have to be passed with -I for the includes that aren't next to the including file
+    :param repo_path: Path to the repository root
+    :param units: Translation units with 'source' (relative to the repo root) and 'includes'
+    :return: Sorted directories relative to the repo root
+    """
+    headers: dict[str, list[str]] = {}  # basename -> headers relative to the repo root
+    for root, _, files in os.walk(repo_path):
+        for name in files:
+            if name.endswith('.h'):
+                headers.setdefault(name, []).append(os.path.relpath(os.path.join(root, name), repo_path))
+
+    include_dirs = set()
+    for unit in units:
+        directory = os.path.dirname(unit['source'])
+        for name in unit['includes']:
+            if os.path.isfile(os.path.join(repo_path, directory, name)):
+                continue
+            for header in headers.get(os.path.basename(name), []):
+                # the include may name a subdirectory, e.g. 'lib/foo.h' found as 'include/lib/foo.h'
+                if header == name or header.endswith(os.sep + name):
+                    include_dirs.add(os.path.normpath(header[:len(header) - len(name)] or os.curdir))
+    return sorted(include_dirs)
+
+
+def run_gcc(repo_path: str, cfiles: list, sandbox: Sandbox = None, usage: dict = None) -> (str, str, str):
+    """
+    Fallback build for repos without a build system
+    Every .c file is compiled to an object file on its own, in parallel and through the object cache,
+    then every file with a main() function is linked with the objects without one into an executable of the same name
+    Files that don't compile are left out instead of failing the whole build
+    Compiler and linker only write to a temporary directory, so they don't need the sandbox,
+    the executables are put into the tree when they're done
+    :param repo_path: Path to the root of the tree the build runs in
+    :param cfiles: List of paths to all .c files in the repo
+    :param sandbox: Sandbox the build runs in, for placing the executables (optional)
+    :param usage: Resource usage of the build, updated in place (optional)
+    :return: executed command, stdout, stderr
+    """
+    units = []
+    for path in cfiles:
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+        except OSError as e:
+            print(f"Could not read {path}: {e}")
+            continue
+        features = scan_c_source(raw.decode('utf-8', errors='replace'))
+        units.append({
+            'source': os.path.relpath(path, repo_path),
+            'hash': hashlib.sha1(raw).hexdigest(),
+            'includes': features['includes'],
+            'has_main': features['has_main'],
+        })
+
+    include_dirs = find_include_dirs(repo_path, units)
+    flags = ([f'-I{path}' for path in include_dirs]
+             + shlex.split(os.getenv('CPPFLAGS', '')) + shlex.split(os.getenv('CFLAGS', '')))
+    resolver = object_cache.IncludeResolver(repo_path, include_dirs)
+    for unit in units:
+        headers = resolver.closure(unit['includes'], os.path.join(repo_path, os.path.dirname(unit['source'])))
+        unit['key'] = object_cache.object_key(unit['source'], unit['hash'], headers, flags)
+
+    print(f"Run gcc: {repo_path} ({len(units)} files, {BUILD_JOBS} parallel jobs)")
+    start = time.monotonic()
+    out_log = []
+    err_log = []
+    parts = []  # resource usage of every command
+
+    def run(command: list[str]) -> (int, str):
+        part = {'Cpu_user': 0.0, 'Cpu_sys': 0.0, 'Max_rss': 0, 'Wall_time': 0.0}
+        returncode, _, err = run_subprocess(command, repo_path, v=V_FLAG, usage=part)
+        parts.append(part)
+        return returncode, err
+
+    def compile_unit(unit: dict) -> (str, str):
+        if object_cache.fetch(unit['key'], unit['object']):
+            return 'cached', ''
+        returncode, err = run(['gcc', '-c', unit['source'], '-o', unit['object']] + flags)
+        if returncode == 0 and os.path.isfile(unit['object']):
+            object_cache.store(unit['key'], unit['object'])
+            return 'compiled', err
+        return 'failed', err
+
+    with tempfile.TemporaryDirectory(prefix='objects-') as object_dir, ThreadPoolExecutor(BUILD_JOBS) as pool:
+        # objects are kept out of the tree, only the executables are build output
+        for i, unit in enumerate(units):
+            unit['object'] = os.path.join(object_dir, f'{i}.o')
+        compiled = []
+        for unit, (status, err) in zip(units, pool.map(compile_unit, units)):
+            out_log.append(f"{status} {unit['source']}")
+            err_log.append(err)
+            if status != 'failed':
+                compiled.append(unit)
+
+        libraries = [unit['object'] for unit in compiled if not unit['has_main']]
+        links = []
+        for unit in compiled:
+            if not unit['has_main']:
+                continue
+            output = os.path.splitext(unit['source'])[0]
+            # e.g. a directory with the same name
+            if os.path.lexists(os.path.join(repo_path, output)):
+                output += '.out'
+            executable = os.path.splitext(unit['object'])[0]
+            links.append((unit['source'], output, executable,
+                          ['gcc', unit['object']] + libraries + ['-o', executable]
+                          + shlex.split(os.getenv('LDFLAGS', '')) + ['-lm'] + shlex.split(os.getenv('LDLIBS', ''))))
+        for (source, output, executable, _), (returncode, err) in zip(
+                links, pool.map(run, [command for *_, command in links])):
+            err_log.append(err)
+            if returncode != 0 or not os.path.isfile(executable):
+                out_log.append(f"failed to link {source}")
+                continue
+            target = sandbox.output_path(output) if sandbox is not None else os.path.join(repo_path, output)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(executable, target)
+            out_log.append(f"linked {source} -> {output}")
+    if not links:
+        out_log.append("no file with a main() function compiled")
+
+    if usage is not None:
+        for part in parts:
+            usage['Cpu_user'] += part['Cpu_user']
+            usage['Cpu_sys'] += part['Cpu_sys']
+            usage['Max_rss'] = max(usage['Max_rss'], part['Max_rss'])
+        # commands run in parallel, their wall times don't add up
+        usage['Wall_time'] += time.monotonic() - start
+    return 'gcc', '\n'.join(out_log), '\n\n'.join(filter(None, err_log))
+
+
+def _read_output(f) -> str:
+    f.seek(0)
+    # universal newlines like Popen with text=True, but undecodable bytes don't fail the build
+    return f.read().decode(errors='replace').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def limit_args() -> list[str]:
+    """
+    Resource limits of build commands as launcher.py arguments, applied by the launcher before the command is executed
+    Limits can only be lowered, so an already lower hard limit is kept
+    :return: List of '<resource>=<soft>:<hard>' arguments
+    """
+    limits = [
+        ('AS', resource.RLIMIT_AS, MEMORY_LIMIT * MB, 0),
+        # the process gets SIGXCPU at the soft limit and is killed at the hard limit
+        ('CPU', resource.RLIMIT_CPU, CPU_LIMIT, 5),
+        ('NPROC', resource.RLIMIT_NPROC, PROCESS_LIMIT, 0),
+        ('FSIZE', resource.RLIMIT_FSIZE, FILE_SIZE_LIMIT * MB, 0),
+    ]
+    args = []
+    for name, limit, value, grace in limits:
+        if not value:
+            continue
+        soft, hard = value, value + grace
+        _, current = resource.getrlimit(limit)
+        if current != resource.RLIM_INFINITY:
+            soft, hard = min(soft, current), min(hard, current)
+        args.append(f"{name}={soft}:{hard}")
+    return args
 
 
-def save_dir_structure(top: str, fname: str, recurse: bool = True):
+def read_report(f) -> dict:
+    """
+    :param f: File the launcher wrote its report to, see launcher.py
+    :return: Dictionary with 'usage' (user and system CPU seconds and max RSS in KB of the command)
+    and 'error' (why the command couldn't be started), each only if it was reported
     """
-    List paths of all files and dirs contained in a root directory
-    Save the output in a file
+    f.seek(0)
+    report = {}
+    for line in f.read().decode(errors='replace').splitlines():
+        kind, _, value = line.partition(' ')
+        if kind == 'usage':
+            user, system, max_rss = value.split()
+            report['usage'] = {'Cpu_user': float(user), 'Cpu_sys': float(system), 'Max_rss': int(max_rss)}
+        elif kind == 'error':
+            report['error'] = value
+    return report
+
+
+def add_usage(usage: dict, command_usage: dict | None, wall_time: float):
     """
-    with open(fname, 'a', encoding='utf-8') as f:
-        for root, dirs, files in os.walk(top):
-            root = root.encode('utf-8', 'replace').decode()
-            for name in files:
-                name = name.encode('utf-8', 'replace').decode()
-                f.write(os.path.join(root, name) + '\n')
-            if not recurse:
-                break
+    Add the resources used by a command to the totals of the build
+    :param usage: Totals with 'Cpu_user', 'Cpu_sys' and 'Wall_time' in seconds and 'Max_rss' in KB
+    :param command_usage: Usage of the command reported by the launcher (None if it wasn't reported)
+    :param wall_time: Time the command took in seconds
+    """
+    usage['Wall_time'] += wall_time
+    if command_usage is not None:
+        usage['Cpu_user'] += command_usage['Cpu_user']
+        usage['Cpu_sys'] += command_usage['Cpu_sys']
+        # the biggest single process
+        usage['Max_rss'] = max(usage['Max_rss'], command_usage['Max_rss'])
 
 
-def compare_dir_structure(before_file: str, after_file: str) -> list[str]:
+def run_subprocess(command: list, cwd: str, v: bool = False, sandbox: Sandbox = None,
+                   usage: dict = None, env: dict = None) -> (int, str, str):
     """
-    Given two files (before and after changes), list new paths that were added
-    :param before_file: Original file list (full paths)
-    :param after_file: Updated file list (full paths)
-    :return: List of file paths (full) that didn't exist in the original file
+    Run a build command with resource limits (see limit_args) and a wall-clock timeout
+    The command is started by launcher.py, which applies the limits and reports its resource usage
+    No code runs in the forked child before exec, so it's safe to call from several threads
+    :param command:
+    :param cwd:
+    :param v: Verbosity (default False)
+    :param sandbox: Sandbox to run the command in (optional)
+    :param usage: Resource usage totals to add the command's usage to (optional, see add_usage)
+    :param env: Environment of the command (optional, the current one if not provided)
+    :return: subprocess return code, stdout and stderr
     """
-    with open(before_file, 'r', encoding='utf-8') as f:
-        before = set(f.read().splitlines())
-    with open(after_file, 'r', encoding='utf-8') as f:
-        after = set(f.read().splitlines())
-    return list(after - before)
-
+    if sandbox is not None:
+        command, cwd = sandbox.wrap(command, cwd)
+    start = time.monotonic()
+    report = {}
+    # output goes to files, a command that leaves processes behind doesn't keep the build waiting for its pipes
+    with (tempfile.TemporaryFile() as out_file, tempfile.TemporaryFile() as err_file,
+          tempfile.TemporaryFile() as report_file):
+        try:
+            process = subprocess.Popen([sys.executable, '-S', '-I', LAUNCHER, str(report_file.fileno()),
+                                        *limit_args(), '--', *command],
+                                       cwd=cwd,
+                                       env=env,
+                                       start_new_session=True,
+                                       stdout=out_file,
+                                       stderr=err_file,
+                                       pass_fds=(report_file.fileno(),))
+        except OSError as e:
+            print(e)
+            return None, "", str(e)
 
-def move_compiled_files(compiled_paths: list[str], repo_folder: str):
+        try:
+            process.wait(timeout=BUILD_TIMEOUT or None)
+            report = read_report(report_file)
+            if 'error' in report:
+                # e.g. the build tool isn't installed
+                print(report['error'])
+                return None, "", report['error']
+            stdout, stderr = _read_output(out_file), _read_output(err_file)
+            if v:
+                if stdout:
+                    print(f"\nSTDOUT:\n{stdout}")
+                if stderr:
+                    print(f"\nSTDERR:\n{stderr}")
+            return process.returncode, stdout, stderr
+        except subprocess.TimeoutExpired:
+            os.killpg(os.getpgid(process.pid), signal.SIGTERM)  # terminate the whole process group
+            print("Timeout")
+            # attempt to get any output after killing the process
+            try:
+                process.wait(timeout=10)
+                report = read_report(report_file)
+                stdout, stderr = _read_output(out_file), _read_output(err_file)
+            except subprocess.TimeoutExpired:
+                stdout, stderr = None, "Timeout"
+            if v:
+                if stdout:
+                    print(f"\nSTDOUT:\n\n{stdout}")
+                if stderr:
+                    print(f"\nSTDERR:\n\n{stderr}")
+            return None, stdout, stderr
+        except Exception as e:
+            print(e)
+            return None, "", str(e)
+        finally:
+            if usage is not None:
+                add_usage(usage, report.get('usage'), time.monotonic() - start)
+
+
+def move_compiled_files(compiled_paths: list[str], repo_folder: str, copy: bool = False, relpath=None):
     """
     Move files created during compilation to a new build directory
     :param compiled_paths: Full paths to the new files created during compilation
     :param repo_folder: Root directory of the repository
+    :param copy: Copy the files instead, for files that existed before the build and were only modified
+    :param relpath: Function that makes the paths relative to the repo root, e.g. Sandbox.relpath
+    (default strip_path)
     """
     for item_path in compiled_paths:
-        if os.path.isfile(item_path):
+        # symbolic links are moved as they are, even if they point to a directory
+        if os.path.isfile(item_path) or os.path.islink(item_path):
             # file path relative to the repo folder
             # if the file was outside the repo folder, it's treated as belonging to the repo root
-            stripped_path = strip_path(item_path, repo_folder)
+            stripped_path = relpath(item_path) if relpath else strip_path(item_path, repo_folder)
             # new folder that the file will be moved to, relative to cwd
             new_folder = os.path.join(BUILD_DIR, repo_folder, os.path.dirname(stripped_path))
             os.makedirs(new_folder, exist_ok=True)
             # new path for the file, relative to cwd
             new_file_path = os.path.join(BUILD_DIR, repo_folder, stripped_path)
-            shutil.move(item_path, new_file_path)
+            if copy:
+                shutil.copy2(item_path, new_file_path, follow_symlinks=False)
+            else:
+                shutil.move(item_path, new_file_path)
+                move_cached(item_path, new_file_path)
             # only report new executables
             if is_executable(new_file_path, v=False):
-                print(f"NEW: {new_file_path}")
+                print(f"{'UPDATED' if copy else 'NEW'}: {new_file_path}")
         else:
             print(f"Build file '{item_path}' not found in the filesystem anymore!!")
 
@@ -263,29 +526,18 @@ def strip_path(file_path: str, repo_folder: str) -> str:
         return os.path.basename(file_path)
 
 
-def is_executable(filepath: str, v: bool = False) -> bool:
-    _, output, _ = run_subprocess(command=['file', filepath], cwd='.', v=False)
-    output = output.strip('\n')
-    if v and 'CMakeFiles' not in filepath:
-        print(output)
-    # trim the file path from the output
-    file_description = output.split(': ', 1)[1].lower()
-    file_ext = os.path.splitext(filepath)[1]
-    if 'CMakeFiles' not in filepath:
-        if 'shared object' in file_description and file_ext != '.so':
-            return True
-        if 'executable' in file_description:
-            if 'text executable' not in file_description:
-                return True
-    return False
-
-
-def clean_up(files_to_rm: list[str]):
+def printable(path: str) -> str:
     """
-    Remove files with listed filepaths
+    Replace undecodable characters in a file name so that it can be logged and saved
     """
-    for f in files_to_rm:
-        os.remove(f)
+    return path.encode('utf-8', 'replace').decode()
+
+
+def is_executable(filepath: str, v: bool = False) -> bool:
+    file_type = get_file_type(filepath)
+    if v and 'CMakeFiles' not in filepath:
+        print(f"{filepath}: {file_type}")
+    return is_executable_type(file_type, filepath)
 
 
 def log_output(repo: str, last_comp: str, process: str, out: str, err: str, new_files: str, execs: str):
@@ -305,7 +557,245 @@ def set_verbosity(v: bool):
     V_FLAG = v
 
 
-def main():
+def jobs_per_build(workers: int) -> int:
+    """
+    :param workers: Number of builds that run at the same time
+    :return: Number of parallel jobs for each of them, so that together they stay within CPU_BUDGET
+    """
+    return max(1, CPU_BUDGET // max(1, workers))
+
+
+def set_build_jobs(jobs: int):
+    global BUILD_JOBS
+    BUILD_JOBS = jobs
+
+
+def init_worker(v: bool, build_jobs: int):
+    """
+    Set up a worker process that runs builds, the settings are module globals and aren't inherited when spawning
+    """
+    set_verbosity(v)
+    set_build_jobs(build_jobs)
+
+
+@functools.cache
+def _installed(tool: str) -> bool:
+    return shutil.which(tool) is not None
+
+
+def can_build(build_system: str, target: str) -> bool:
+    """
+    :param build_system: One of BUILD_TOOLS
+    :param target: Entry point of the build, see build_scanner.build_target
+    :return: Whether the tools needed for the build are installed
+    """
+    tools = BUILD_TOOLS[build_system]
+    if build_system == 'autotools' and not os.path.isfile(os.path.join(target, 'configure')):
+        tools = tools + ['autoreconf']
+    return all(_installed(tool) for tool in tools)
+
+
+def find_build(repo_path: str, saved: tuple[str, str] = None) -> (str | None, str, list[str]):
+    """
+    Choose how the repo should be built, detection is skipped if an earlier run saved its result
+    If the preferred build system isn't installed, the next one found on the same level is used (usually make)
+    :param repo_path: Root directory of the repository (full path, relative to cwd)
+    :param saved: Build system and entry point saved in the database (see saved_build), optional
+    :return: Build system ('cmake', 'meson', 'autotools', 'make', 'gcc' or None if there's nothing to build),
+    its entry point relative to the repo root (CMakeLists.txt for cmake, the directory with the build file
+    for the others, '.' for gcc) and the .c files to compile with gcc if the scan found them
+    """
+    # an entry point that is gone means the repo on disk has changed, e.g. it was downloaded without some files
+    if saved is not None and (not saved[0] or os.path.exists(os.path.join(repo_path, saved[1]))
+                              and can_build(saved[0], os.path.join(repo_path, saved[1]))):
+        return saved[0] or None, saved[1], []
+
+    candidates, cfiles = scan_repo(repo_path)
+    if candidates:
+        # without any usable tools the preferred build fails and its error is recorded
+        build_system, target = next((c for c in candidates if can_build(*c)), candidates[0])
+        return build_system, os.path.relpath(target, repo_path), []
+    if cfiles:
+        return 'gcc', os.curdir, cfiles
+    return None, '', []
+
+
+def saved_build(row: pd.Series) -> tuple[str, str] | None:
+    """
+    :param row: Dataframe row of the repo
+    :return: Build system and entry point found by an earlier run (the system is '' if there was nothing to build),
+    or None if the repo hasn't been scanned yet
+    """
+    if pd.isna(row.get('Build_sys')):
+        return None
+    return row['Build_sys'], '' if pd.isna(row['Build_entry']) else row['Build_entry']
+
+
+def compile_repo(repo_folder: str, repo: str = None, commit: str = None, use_cache: bool = False,
+                 use_inotify: bool = False, sandbox_mode: str = None, build: tuple[str, str] = None,
+                 compiler_cache_mode: str = None) -> dict | None:
+    """
+    Build a single repository and move the generated files to the build directory
+    Files modified by the build (e.g. executables shipped with the repo and rebuilt) are copied there
+    :param repo_folder: Name of the repo root folder ('owner-repo-123abc')
+    :param repo: Full name of the repo ('owner/repo'), needed for the build cache
+    :param commit: Commit hash of the repo state on disk, needed for the build cache
+    :param use_cache: Restore the build from the build cache if possible and store new builds there
+    :param use_inotify: Track the files written by the build with inotify instead of walking the directories twice
+    :param sandbox_mode: Build in a scratch working tree instead of the repo itself, one of sandbox.MODES
+    (optional, the output is then exactly what the build wrote to the tree)
+    :param build: Build system and entry point saved by an earlier run, skips detection (optional, see saved_build)
+    :param compiler_cache_mode: Run the compilers of build systems through a compiler cache shared by all repos,
+    one of compiler_cache.MODES (optional, the gcc fallback always uses the object cache)
+    :return: Dictionary with the compilation results, or None if the repo was not found on disk
+    """
+    repo_path = os.path.join(SOURCE_DIR, repo_folder)  # full path
+
+    if not os.path.isdir(repo_path):
+        print(f"{repo_path} not found on disk")
+        return None
+
+    build_system, build_entry, cfiles = find_build(repo_path, build)
+    detected = {'Build_sys': build_system or '', 'Build_entry': build_entry}
+
+    key = None
+    if use_cache and repo and pd.notna(commit) and commit and build_system:
+        key = build_cache.cache_key(repo, commit, build_system, build_entry)
+        cached = build_cache.restore(key, os.path.join(BUILD_DIR, repo_folder))
+        if cached is not None:
+            print(f"Restored {repo_folder} from build cache")
+            return dict(cached, **detected, Last_comp=str(datetime.now().replace(microsecond=0)))
+
+    sandbox = None
+    if sandbox_mode:
+        sandbox = Sandbox(repo_path, os.path.join(SANDBOX_DIR, repo_folder), sandbox_mode)
+        build_root = sandbox.root
+        relpath = sandbox.relpath
+    else:
+        tracker = start_tracking([
+            (repo_path, True, frozenset()),
+            # only the top of cwd because sometimes files end up there, its subfolders belong to the pipeline
+            (os.getcwd(), False, frozenset()),
+            # the top of the source directory for the same reason, the other repos are in its subfolders
+            (SOURCE_DIR, False, frozenset()),
+        ], use_inotify)
+        build_root = repo_path
+        relpath = functools.partial(strip_path, repo_folder=repo_folder)
+
+    def rebase(path: str) -> str:
+        # the same path in the tree the build runs in
+        return os.path.normpath(os.path.join(build_root, os.path.relpath(path, repo_path)))
+
+    # process, output, error
+    result: list[str] = ['', '', '']
+
+    usage = {'Cpu_user': 0.0, 'Cpu_sys': 0.0, 'Max_rss': 0, 'Wall_time': 0.0}
+
+    env = None
+    stats_file = None
+    if compiler_cache_mode and build_system not in (None, 'gcc'):
+        launcher = compiler_cache.resolve_mode(compiler_cache_mode)
+        # outside of the tree, so it's not mistaken for build output
+        fd, stats_file = tempfile.mkstemp(prefix='compiler-cache-', suffix='.log')
+        os.close(fd)
+        env = compiler_cache.launcher_env(launcher, build_root, stats_file)
+
+    build_target = os.path.normpath(os.path.join(build_root, build_entry))
+    if build_system == 'cmake':
+        result = run_cmake(build_target, build_root, sandbox, usage, env)
+    elif build_system == 'make':
+        result = run_make(build_target, sandbox, usage, env)
+    elif build_system == 'autotools':
+        result = run_autotools(build_target, sandbox, usage, env)
+    elif build_system == 'meson':
+        result = run_meson(build_target, sandbox, usage, env)
+    elif build_system == 'gcc':
+        # saved results don't include the .c files, they're only listed when they're needed
+        cfiles = cfiles or scan_repo(repo_path)[1]
+        result = run_gcc(build_root, [rebase(f) for f in cfiles], sandbox, usage)
+    print(f"Resources: {usage['Cpu_user']:.1f} s user, {usage['Cpu_sys']:.1f} s system, "
+          f"{usage['Wall_time']:.1f} s wall, {usage['Max_rss'] / 1024:.0f} MB max RSS")
+    cache_stats = None
+    if stats_file is not None:
+        cache_stats = compiler_cache.read_stats(stats_file)
+        os.remove(stats_file)
+        print(f"Compiler cache: {compiler_cache.summary(cache_stats)}")
+
+    if sandbox is not None:
+        diff, modified = sandbox.changes()
+    else:
+        diff, modified = tracker.changes()
+        tracker.close()
+
+    # only store relative paths (cwd or repo prefix stripped)
+    compiled = {
+        'Last_comp': str(datetime.now().replace(microsecond=0)),
+        'Process': result[0] if result[0] else '',
+        'Out': result[1].strip('\n ') if result[1] else '',
+        'Err': result[2].strip('\n ') if result[2] else '',
+        'New_files': '\n'.join([printable(relpath(f)) for f in diff]),
+        'Execs': '\n'.join([printable(relpath(f)) for f in diff + modified if is_executable(f, v=V_FLAG)]),
+        'Cpu_user': round(usage['Cpu_user'], 3),
+        'Cpu_sys': round(usage['Cpu_sys'], 3),
+        'Max_rss': usage['Max_rss'],
+        'Wall_time': round(usage['Wall_time'], 3),
+        **detected,
+        'Compiler_cache': cache_stats,
+    }
+
+    move_compiled_files(diff, repo_folder, relpath=relpath)
+    # the sandbox is thrown away, so modified files don't have to stay where they are
+    move_compiled_files(modified, repo_folder, copy=sandbox is None, relpath=relpath)
+    if sandbox is not None:
+        sandbox.remove()
+    if key is not None:
+        build_cache.store(key, os.path.join(BUILD_DIR, repo_folder),
+                          {k: v for k, v in compiled.items()
+                           if k not in ('Last_comp', 'Compiler_cache') and k not in detected})
+    # share file classifications with Archiver
+    save_cache()
+    return compiled
+
+
+def record_result(df: pd.DataFrame, index: str, compiled: dict | None):
+    """
+    Log the compilation results of a repo and write them to the dataframe
+    Only called from the coordinating process, so that the log and the database have a single writer
+    :param df: Dataframe with all repo data
+    :param index: Name of the repo (dataframe index)
+    :param compiled: Output of compile_repo
+    """
+    if compiled is None:
+        df.at[index, 'On_disk'] = False
+        return
+
+    # log to csv
+    log_output(index, compiled['Last_comp'], compiled['Process'], compiled['Out'], compiled['Err'],
+               compiled['New_files'], compiled['Execs'])
+
+    # update the database
+    df.at[index, 'Process'] = compiled['Process']
+    df.at[index, 'Execs'] = compiled['Execs']
+    df.at[index, 'Last_comp'] = compiled['Last_comp']
+    # builds restored from an older build cache entry don't have these
+    for col in USAGE_COLUMNS:
+        df.at[index, col] = compiled.get(col)
+    # saved so that later runs and the build cache don't have to scan the repo again
+    df.at[index, 'Build_sys'] = compiled['Build_sys']
+    df.at[index, 'Build_entry'] = compiled['Build_entry']
+
+
+def main(jobs: int = 1, use_cache: bool = False, use_inotify: bool = False, sandbox_mode: str = None,
+         compiler_cache_mode: str = None):
+    """
+    :param jobs: Number of repos to build concurrently (default 1 builds them one after another),
+    the CPU budget (BUILD_CPUS) is split between them
+    :param use_cache: Reuse builds of the same repo commit with the same toolchain from the build cache
+    :param use_inotify: Track the files written by builds with inotify
+    :param sandbox_mode: Build every repo in its own scratch working tree, one of sandbox.MODES (optional)
+    :param compiler_cache_mode: Run the compilers of build systems through a compiler cache,
+    one of compiler_cache.MODES (optional)
+    """
     os.makedirs(LOG_DIR, exist_ok=True)
 
     # update on-disk status of source repos before doing anything
@@ -318,91 +808,67 @@ def main():
     # only iterate through the repos that are saved to disk
     filtered_df = df[df['On_disk']].copy()
 
-    for index, row in tqdm(filtered_df.iterrows()):
-        print("\nSTART\t" + index)
-        repo_folder = row['Folder']  # only root directory
-        repo_path = os.path.join(SOURCE_DIR, repo_folder)  # full path
-
-        if not os.path.isdir(repo_path):
-            print(f"{repo_path} not found on disk")
-            df.at[index, 'On_disk'] = False
-            continue
-
-        # path for temporary files
-        tmp_dir = 'out'
-        os.makedirs(tmp_dir, exist_ok=True)
-        before = os.path.join(tmp_dir, 'before.txt')
-        after = os.path.join(tmp_dir, 'after.txt')
-
-        # record initial repository structure
-        save_dir_structure(repo_path, before)
-        # record cwd structure because sometimes files end up there
-        save_dir_structure(os.getcwd(), before, recurse=False)
-        # record source directory structure for the same reason
-        save_dir_structure(SOURCE_DIR, before, recurse=False)
-
-        # process, output, error
-        result: list[str] = ['', '', '']
-
-        # assuming there's Makefile or CMakeLists in root
-        cmakelists_path = os.path.join(repo_path, 'CMakeLists.txt')
-        makefile_path = os.path.join(repo_path, 'Makefile')
-
-        if os.path.isfile(cmakelists_path):
-            result = run_cmake(cmakelists_path, repo_path)
-        elif os.path.isfile(makefile_path):
-            result = run_make(repo_path)
-        else:
-            # walk the repo and find the next best option
-            makefiles, cmakelists, cfiles = get_relevant_files(repo_path)
-            if cmakelists:
-                cmakelists_path = find_best_file(cmakelists)
-                result = run_cmake(cmakelists_path, repo_path)
-            elif makefiles:
-                makefile_path = find_best_file(makefiles)
-                makefile_dir = os.path.dirname(makefile_path)
-                result = run_make(makefile_dir)
-            elif cfiles:
-                result = run_gcc(repo_path, cfiles)
-
-        # record directory structure after compilation
-        save_dir_structure(repo_path, after)
-        # TODO check cwd structure deeper than one level
-        save_dir_structure(os.getcwd(), after, recurse=False)
-        save_dir_structure(SOURCE_DIR, after, recurse=False)
-
-        # the files passed as arguments contain full paths
-        diff = compare_dir_structure(before, after)
-
-        # format the output data/logs
-        last_comp = str(datetime.now().replace(microsecond=0))
-        process = result[0] if result[0] else ''
-        out = result[1].strip('\n ') if result[1] else ''
-        err = result[2].strip('\n ') if result[2] else ''
-        # only store relative paths (cwd or repo prefix stripped)
-        new_files = '\n'.join([strip_path(f, repo_folder) for f in diff])
-        execs = '\n'.join([strip_path(f, repo_folder) for f in diff if is_executable(f, v=V_FLAG)])
-
-        # log to csv
-        log_output(index, last_comp, process, out, err, new_files, execs)
-
-        # update the database
-        df.at[index, 'Process'] = process
-        df.at[index, 'Execs'] = execs
-        df.at[index, 'Last_comp'] = str(datetime.now().replace(microsecond=0))
-
-        move_compiled_files(diff, repo_folder)
-        clean_up([before, after])
-        wrapup(data=df)
-        print(f"DONE\t{repo_folder}\n")
+    set_build_jobs(jobs_per_build(jobs))
+    print(f"{jobs} concurrent build(s) with {BUILD_JOBS} parallel job(s) each")
+    cache_stats = {'hits': 0, 'misses': 0}
+
+    def finish(index: str, compiled: dict | None):
+        record_result(df, index, compiled)
+        wrapup(data=df, rows=[index])
+        if compiled is not None and compiled.get('Compiler_cache'):
+            for key, count in compiled['Compiler_cache'].items():
+                cache_stats[key] += count
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(V_FLAG, BUILD_JOBS)) as pool:
+            futures = {pool.submit(compile_repo, row['Folder'], index, row['Commit'], use_cache, use_inotify,
+                                   sandbox_mode, saved_build(row), compiler_cache_mode): index
+                       for index, row in filtered_df.iterrows()}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                index = futures[future]
+                finish(index, future.result())
+                print(f"DONE\t{filtered_df.at[index, 'Folder']}\n")
+    else:
+        for index, row in tqdm(filtered_df.iterrows()):
+            print("\nSTART\t" + index)
+            finish(index, compile_repo(row['Folder'], index, row['Commit'], use_cache, use_inotify,
+                                       sandbox_mode, saved_build(row), compiler_cache_mode))
+            print(f"DONE\t{row['Folder']}\n")
+    if compiler_cache_mode:
+        print(f"Compiler cache for this run: {compiler_cache.summary(cache_stats)}")
+    # once per run, they walk the whole cache
+    object_cache.evict()
+    compact_cache()
+    if use_cache:
+        build_cache.evict()
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        description="Build the repos that are on disk. Repos without build files are compiled with gcc file by file, "
+                    "always through the object cache (use .env to set OBJECT_CACHE_DIR and OBJECT_CACHE_SIZE in MB)")
     parser.add_argument('-v', '--verbose',
                         action='store_true',
                         help="Enable verbose output for the compilation process and the file type identification "
                              "(Note: Files under the 'CMakeFiles' directory are ignored.)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of repos to build concurrently in separate worker processes (default 1), "
+                             "BUILD_CPUS in .env (default all CPUs) is split between them for parallel make jobs")
+    parser.add_argument('--cache', action='store_true',
+                        help="Restore builds of the same repo commit and toolchain from the build cache "
+                             "(use .env to set BUILD_CACHE_DIR and BUILD_CACHE_SIZE in MB)")
+    parser.add_argument('--inotify', action='store_true',
+                        help="Track files written by builds with inotify instead of scanning the directories "
+                             "before and after each build (Linux only, falls back to scanning)")
+    parser.add_argument('--sandbox', nargs='?', const='auto', choices=SANDBOX_MODES,
+                        help="Build every repo in its own scratch working tree: an overlay in a private mount "
+                             "namespace, a copy made of hard links, or 'auto' (default) to pick the first that works. "
+                             "Builds can't change the downloaded repos and only files written to the tree are kept")
+    parser.add_argument('--compiler-cache', nargs='?', const='auto', choices=COMPILER_CACHE_MODES,
+                        help="Run the compilers of make, cmake, autotools and meson builds through a cache shared "
+                             "by all repos: ccache, the built-in cache of preprocessed sources, or 'auto' (default) "
+                             "for ccache if it's installed. The size limit is OBJECT_CACHE_SIZE in .env")
     args = parser.parse_args()
     set_verbosity(args.verbose)
-    main()
+    main(jobs=args.jobs, use_cache=args.cache, use_inotify=args.inotify, sandbox_mode=args.sandbox,
+         compiler_cache_mode=args.compiler_cache)
@@ -0,0 +1,308 @@
+"""
+Compiler cache for builds that run their own compiler commands (make, cmake, autotools, meson)
+Builds find the compilers in a directory that is put first in PATH: links to ccache, which then runs the real compiler,
+or scripts that run this module as a wrapper around it
+The wrapper hashes the preprocessed source and the compiler flags and keeps the objects in the object cache,
+so they're shared with the gcc fallback build and its size limit and eviction apply
+"""
+import functools
+import hashlib
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from .build_cache import CACHE_DIR
+from . import object_cache
+
+MODES = ['auto', 'ccache', 'builtin']
+COMPILERS = ['cc', 'gcc', 'c++', 'g++']
+CCACHE_DIR = os.path.join(CACHE_DIR, 'ccache')
+
+# settings of the built-in wrapper, passed to it in the environment of the build
+ROOT_VAR = 'CC_WRAPPER_ROOT'  # root of the tree the build runs in
+BIN_VAR = 'CC_WRAPPER_BIN'  # directory with the wrapper scripts, skipped when looking for the real compiler
+CACHE_VAR = 'CC_WRAPPER_CACHE'  # absolute path of the object cache
+STATS_VAR = 'CC_WRAPPER_STATS'  # file that gets a line with the result of every compiler call
+# the root of the tree is replaced in paths, so that builds of other repos with the same files get the same key
+ROOT_PLACEHOLDER = b'@ROOT@'
+# only in the line markers of preprocessed code, a path in a string (e.g. from __FILE__) ends up in the object
+LINE_MARKER = rb'^(# \d+ ")'
+
+# results written to the stats file, the built-in wrapper's and the ones ccache writes to its stats log
+HITS = {'hit', 'direct_cache_hit', 'preprocessed_cache_hit'}
+MISSES = {'miss', 'cache_miss'}
+
+# options followed by a separate argument
+ARG_OPTIONS = {
+    '-o', '-MF', '-MT', '-MQ', '-I', '-D', '-U', '-include', '-imacros', '-isystem', '-iquote', '-idirafter',
+    '-iprefix', '-iwithprefix', '-iwithprefixbefore', '-isysroot', '--sysroot', '-x', '-Xpreprocessor',
+    '-Xassembler', '-Xlinker', '--param', '-aux-info', '-L', '-l',
+}
+# calls that don't just turn one source file into one object file
+UNCACHEABLE = {'-E', '-S', '-M', '-MM', '-x', '-', '--coverage', '-fprofile-arcs', '-ftest-coverage'}
+SOURCE_EXTENSIONS = {'.c', '.cc', '.cpp', '.cxx', '.C'}
+
+
+@functools.cache
+def resolve_mode(mode: str) -> str:
+    """
+    :param mode: One of MODES
+    :return: 'ccache' or 'builtin', 'auto' picks ccache if it's installed
+    """
+    if mode in ('auto', 'ccache') and shutil.which('ccache'):
+        return 'ccache'
+    if mode == 'ccache':
+        print("ccache not found, using the built-in compiler cache instead")
+    return 'builtin'
+
+
+@functools.cache
+def shim_dir(mode: str) -> str:
+    """
+    Create the directory with the compilers that builds should call, once per process
+    :param mode: 'ccache' or 'builtin'
+    :return: Absolute path of the directory
+    """
+    path = os.path.abspath(os.path.join(CACHE_DIR, f'bin-{mode}'))
+    os.makedirs(path, exist_ok=True)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for name in COMPILERS:
+        if not shutil.which(name):
+            continue
+        shim = os.path.join(path, name)
+        tmp_shim = f"{shim}.{os.getpid()}.tmp"
+        if mode == 'ccache':
+            # ccache called by the name of a compiler runs the next compiler of that name in PATH
+            os.symlink(shutil.which('ccache'), tmp_shim)
+        else:
+            with open(tmp_shim, 'wt', encoding='utf-8') as f:
+                f.write(f'#!/bin/sh\nPYTHONPATH={shlex.quote(package_root)} '
+                        f'exec {shlex.quote(sys.executable)} -m src.compiler_cache {name} "$@"\n')
+            os.chmod(tmp_shim, 0o755)
+        # other workers may be creating the same directory
+        os.replace(tmp_shim, shim)
+    return path
+
+
+def launcher_env(mode: str, root: str, stats_file: str) -> dict[str, str]:
+    """
+    :param mode: 'ccache' or 'builtin'
+    :param root: Root of the tree the build runs in
+    :param stats_file: File where the result of every compiler call is recorded, see read_stats
+    :return: Environment for the build commands
+    """
+    env = dict(os.environ)
+    bin_dir = shim_dir(mode)
+    env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+    if mode == 'ccache':
+        env.update({
+            'CCACHE_DIR': os.path.abspath(CCACHE_DIR),
+            'CCACHE_MAXSIZE': f'{int(object_cache.OBJECT_CACHE_SIZE)}M',
+            # absolute paths in the tree are hashed as relative ones, so repos in other folders can share objects
+            'CCACHE_BASEDIR': os.path.abspath(root),
+            'CCACHE_STATSLOG': os.path.abspath(stats_file),
+        })
+    else:
+        env.update({
+            ROOT_VAR: os.path.abspath(root),
+            BIN_VAR: bin_dir,
+            CACHE_VAR: os.path.abspath(object_cache.OBJECT_CACHE_DIR),
+            STATS_VAR: os.path.abspath(stats_file),
+        })
+    return env
+
+
+def read_stats(stats_file: str) -> dict[str, int]:
+    """
+    :param stats_file: File written by the compiler calls of a build
+    :return: Number of cache 'hits' and 'misses', calls that can't be cached (e.g. linking) aren't counted
+    """
+    stats = {'hits': 0, 'misses': 0}
+    try:
+        with open(stats_file, 'rt', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                result = line.strip()
+                if result in HITS:
+                    stats['hits'] += 1
+                elif result in MISSES:
+                    stats['misses'] += 1
+    except OSError:
+        pass
+    return stats
+
+
+def summary(stats: dict[str, int]) -> str:
+    """
+    :param stats: Numbers of 'hits' and 'misses', see read_stats
+    """
+    calls = stats['hits'] + stats['misses']
+    rate = f", {stats['hits'] / calls:.0%} hit rate" if calls else ''
+    return f"{stats['hits']} hits, {stats['misses']} misses{rate}"
+
+
+def parse_args(args: list[str]) -> dict | None:
+    """
+    :param args: Arguments of a compiler call
+    :return: Dictionary with the 'source', 'output' and 'depfile' (or None) of the call, 'preprocess' arguments
+    and 'key' arguments to hash, or None if the call doesn't compile a single source file to an object file
+    """
+    if '-c' not in args:
+        return None
+    source = output = depfile = None
+    make_depfile = False
+    preprocess = []
+    key = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        value = args[i + 1] if arg in ARG_OPTIONS and i + 1 < len(args) else None
+        i += 1 if value is None else 2
+        if arg in UNCACHEABLE or arg.startswith(('@', '-save-temps', '-fprofile')):
+            return None
+        if arg == '-c':
+            key.append(arg)
+        elif arg.startswith('-o'):
+            output = value if arg == '-o' else arg[2:]
+        elif arg in ('-MD', '-MMD'):
+            make_depfile = True
+            key.append(arg)
+        elif arg.startswith('-MF'):
+            depfile = value if arg == '-MF' else arg[3:]
+        elif arg.startswith(('-MT', '-MQ', '-MP')):
+            # they only change the dependency file
+            key += [arg] if value is None else [arg, value]
+        elif not arg.startswith('-'):
+            if source is not None or os.path.splitext(arg)[1] not in SOURCE_EXTENSIONS:
+                return None
+            source = arg
+        else:
+            preprocess += [arg] if value is None else [arg, value]
+    if source is None:
+        return None
+
+    if output is None:
+        output = os.path.splitext(os.path.basename(source))[0] + '.o'
+    if make_depfile:
+        depfile = depfile or os.path.splitext(output)[0] + '.d'
+        # the dependency file names the object
+        key += ['-o', output]
+    else:
+        depfile = None
+    return {
+        'source': source,
+        'output': output,
+        'depfile': depfile,
+        'preprocess': preprocess + [source],
+        'key': key + preprocess,
+    }
+
+
+def _record(result: str):
+    stats_file = os.environ.get(STATS_VAR)
+    if not stats_file:
+        return
+    # a single short write to a file opened for appending doesn't mix with the lines of parallel calls
+    fd = os.open(stats_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, f'{result}\n'.encode())
+    finally:
+        os.close(fd)
+
+
+def _normalize(data: bytes, root: bytes) -> bytes:
+    return data.replace(root, ROOT_PLACEHOLDER) if root else data
+
+
+def _store_data(key: str, data: bytes, suffix: str):
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(data)
+    try:
+        object_cache.store(key, f.name, suffix)
+    finally:
+        os.remove(f.name)
+
+
+def _fetch_data(key: str, suffix: str) -> bytes | None:
+    with tempfile.NamedTemporaryFile() as f:
+        if not object_cache.fetch(key, f.name, suffix):
+            return None
+        return f.read()
+
+
+def wrap(name: str, args: list[str]) -> int:
+    """
+    Run a compiler call through the object cache
+    :param name: Name the compiler was called by
+    :param args: Arguments of the call
+    :return: Exit status of the call
+    """
+    bin_dir = os.environ.get(BIN_VAR, '')
+    search_path = os.pathsep.join(path for path in os.environ.get('PATH', '').split(os.pathsep)
+                                  if path and os.path.abspath(path) != bin_dir)
+    compiler = shutil.which(name, path=search_path)
+    if compiler is None:
+        print(f"{name}: compiler not found", file=sys.stderr)
+        return 127
+
+    call = parse_args(args)
+    if call is None:
+        _record('uncacheable')
+        os.execv(compiler, [compiler] + args)
+    preprocessed = subprocess.run([compiler, '-E'] + call['preprocess'], stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL)
+    if preprocessed.returncode != 0:
+        # the compiler reports the error
+        _record('uncacheable')
+        os.execv(compiler, [compiler] + args)
+
+    root = os.environ.get(ROOT_VAR, '').encode()
+    object_cache.OBJECT_CACHE_DIR = os.environ.get(CACHE_VAR, object_cache.OBJECT_CACHE_DIR)
+    stat = os.stat(compiler)
+    digest = hashlib.sha256()
+    # like ccache, the compiler is identified by its path, size and modification time
+    digest.update(f'{compiler}\0{stat.st_size}\0{stat.st_mtime_ns}\0'.encode())
+    digest.update(_normalize('\0'.join(call['key']).encode(), root) + b'\0')
+    code = preprocessed.stdout
+    if root:
+        code = re.sub(LINE_MARKER + re.escape(root), rb'\1' + ROOT_PLACEHOLDER, code, flags=re.MULTILINE)
+    digest.update(code)
+    key = digest.hexdigest()
+
+    if object_cache.fetch(key, call['output']):
+        depfile = _fetch_data(key, '.d') if call['depfile'] else b''
+        if depfile is not None:
+            if call['depfile']:
+                with open(call['depfile'], 'wb') as f:
+                    f.write(depfile.replace(ROOT_PLACEHOLDER, root) if root else depfile)
+            # warnings are shown again, like on the first compilation
+            warnings = _fetch_data(key, '.err') or b''
+            sys.stderr.buffer.write(warnings.replace(ROOT_PLACEHOLDER, root) if root else warnings)
+            _record('hit')
+            return 0
+
+    result = subprocess.run([compiler] + args, stderr=subprocess.PIPE)
+    sys.stderr.buffer.write(result.stderr)
+    if result.returncode != 0 or not os.path.isfile(call['output']):
+        _record('failed')
+        return result.returncode
+    # the object is stored last, a concurrent call that finds it also finds the rest
+    if result.stderr:
+        _store_data(key, _normalize(result.stderr, root), '.err')
+    if call['depfile']:
+        if not os.path.isfile(call['depfile']):
+            # compiled, but it can't be restored from the cache without its dependency file
+            _record('miss')
+            return result.returncode
+        with open(call['depfile'], 'rb') as f:
+            _store_data(key, _normalize(f.read(), root), '.d')
+    object_cache.store(key, call['output'])
+    _record('miss')
+    return result.returncode
+
+
+if __name__ == "__main__":
+    sys.exit(wrap(sys.argv[1], sys.argv[2:]))
@@ -1,5 +1,6 @@
 import json
 import os
+import sqlite3
 
 import pandas as pd
 
@@ -8,10 +9,45 @@ from dotenv import load_dotenv
 load_dotenv()
 
 DATA_DIR = 'data'
-DF_FILE = os.path.join(DATA_DIR, 'data.pkl')
+DB_FILE = os.path.join(DATA_DIR, 'data.db')
+LEGACY_DF_FILE = os.path.join(DATA_DIR, 'data.pkl')  # migrated to DB_FILE on first load
 MONTHS_FILE = os.path.join(DATA_DIR, 'months_tracker.json')
 os.makedirs(DATA_DIR, exist_ok=True)
 
+TABLE = 'repos'
+COLUMNS = {
+    'Repo': 'string',
+    'Commit': 'string',
+    'Pushed': 'string',
+    'Size': 'int32',
+    'Stars': 'int32',
+    'C_ratio': 'float32',
+    'Langs': 'object',
+    'Build_sys': 'string',
+    'Build_entry': 'string',
+    'Process': 'string',
+    'Execs': 'string',
+    'Last_comp': 'string',
+    'Cpu_user': 'float32',
+    'Cpu_sys': 'float32',
+    'Max_rss': 'Int64',
+    'Wall_time': 'float32',
+    'Folder': 'string',
+    'On_disk': 'bool',
+    'Archived': 'bool',
+}
+INDEXED_COLUMNS = ['Folder', 'On_disk', 'Last_comp', 'Pushed']
+# SQLite column types for pandas dtypes, anything else is stored as TEXT
+SQL_TYPES = {
+    'int32': 'INTEGER',
+    'int64': 'INTEGER',
+    'Int64': 'INTEGER',
+    'float32': 'REAL',
+    'float64': 'REAL',
+    'bool': 'INTEGER',
+    'boolean': 'INTEGER',
+}
+
 
 class EmptyDatasetError(Exception):
     """
@@ -22,26 +58,10 @@ class EmptyDatasetError(Exception):
 
 
 def initialize() -> (pd.DataFrame, list[str]):
-    if os.path.isfile(DF_FILE):
+    if os.path.isfile(DB_FILE) or os.path.isfile(LEGACY_DF_FILE):
         data = load_database()
     else:
-        columns = {
-            'Repo': 'string',
-            'Commit': 'string',
-            'Pushed': 'string',
-            'Size': 'int32',
-            'Stars': 'int32',
-            'C_ratio': 'float32',
-            'Langs': 'object',
-            'Process': 'string',
-            'Execs': 'string',
-            'Last_comp': 'string',
-            'Folder': 'string',
-            'On_disk': 'bool',
-            'Archived': 'bool',
-        }
-
-        data = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in columns.items()})
+        data = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in COLUMNS.items()})
         data.set_index('Repo', inplace=True)
 
     if os.path.isfile(MONTHS_FILE):
@@ -51,19 +71,114 @@ def initialize() -> (pd.DataFrame, list[str]):
     return data, months
 
 
-def wrapup(data: pd.DataFrame, months: list[str] = None):
+def wrapup(data: pd.DataFrame, months: list[str] = None, rows=None):
+    """
+    Save the dataframe (and optionally the months tracker)
+    :param data: Dataframe with all repo data
+    :param months: List of processed months (optional)
+    :param rows: Index labels of the rows that have changed (optional, all rows are saved if not provided)
+    """
     os.makedirs(DATA_DIR, exist_ok=True)
-    update_database(data)
+    update_database(data, rows)
     if months:
         update_months_tracker(months)
 
 
-def load_database():
-    return pd.read_pickle(DF_FILE)
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_FILE)
+    # WAL lets readers (e.g. another stage of the pipeline) work while a write is in progress
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'CREATE TABLE IF NOT EXISTS "{TABLE}" ("Repo" TEXT PRIMARY KEY)')
+    # pandas dtype of every column, used to restore the dataframe exactly as it was saved
+    conn.execute('CREATE TABLE IF NOT EXISTS "columns" ("name" TEXT PRIMARY KEY, "dtype" TEXT NOT NULL)')
+    return conn
 
 
-def update_database(data: pd.DataFrame):
-    data.to_pickle(DF_FILE)
+def _get_dtypes(conn: sqlite3.Connection) -> dict[str, str]:
+    return dict(conn.execute('SELECT "name", "dtype" FROM "columns"').fetchall())
+
+
+def load_database(where: str = None, params: tuple = ()) -> pd.DataFrame:
+    """
+    Load the repo data from the database
+    :param where: SQL condition to load only a subset of the rows, e.g. 'On_disk = 1' (optional)
+    :param params: Parameters for the placeholders in the condition (optional)
+    :return: Dataframe indexed by repo name
+    """
+    if not os.path.isfile(DB_FILE) and os.path.isfile(LEGACY_DF_FILE):
+        print(f"Migrating {LEGACY_DF_FILE} to {DB_FILE}")
+        update_database(pd.read_pickle(LEGACY_DF_FILE))
+
+    with _connect() as conn:
+        dtypes = _get_dtypes(conn)
+        query = f'SELECT * FROM "{TABLE}"'
+        if where:
+            query += f' WHERE {where}'
+        data = pd.read_sql_query(query, conn, params=params)
+    conn.close()
+
+    # columns that are expected but haven't been saved yet
+    for col, dtype in COLUMNS.items():
+        if col not in data:
+            data[col] = pd.Series(dtype=dtype)
+        dtypes.setdefault(col, dtype)
+
+    for col, dtype in dtypes.items():
+        if col not in data:
+            continue
+        if dtype == 'object':
+            data[col] = data[col].map(lambda x: json.loads(x) if isinstance(x, str) else x)
+        elif dtype == 'bool':
+            data[col] = data[col].fillna(0).astype('bool')
+        else:
+            data[col] = data[col].astype(dtype)
+
+    data.set_index('Repo', inplace=True)
+    return data
+
+
+def update_database(data: pd.DataFrame, rows=None):
+    """
+    Insert or update rows of the dataframe in a single transaction
+    New columns are added to the table automatically
+    :param data: Dataframe indexed by repo name
+    :param rows: Index labels of the rows to save (optional, all rows are saved if not provided)
+    """
+    with _connect() as conn:
+        dtypes = _get_dtypes(conn)
+        new_columns = [col for col in data.columns if col not in dtypes]
+        for col in new_columns:
+            dtype = str(data[col].dtype)
+            sql_type = SQL_TYPES.get(dtype, 'TEXT')
+            conn.execute(f'ALTER TABLE "{TABLE}" ADD COLUMN "{col}" {sql_type}')
+            conn.execute('INSERT OR REPLACE INTO "columns" VALUES (?, ?)', (col, dtype))
+        for col in INDEXED_COLUMNS:
+            if col in data.columns:
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{col}" ON "{TABLE}" ("{col}")')
+
+        # existing rows need a value for a newly added column, so everything is saved
+        if rows is not None and not new_columns:
+            subset = data.loc[list(rows)]
+        else:
+            subset = data
+
+        columns = list(subset.columns)
+        values = [subset.index.tolist()]
+        for col in columns:
+            series = subset[col]
+            if series.dtype == 'object':
+                values.append([json.dumps(x) if isinstance(x, (dict, list)) or not pd.isna(x) else None
+                               for x in series.tolist()])
+            else:
+                values.append([None if pd.isna(x) else x for x in series.tolist()])
+
+        col_names = ', '.join(f'"{col}"' for col in ['Repo'] + columns)
+        placeholders = ', '.join('?' * (len(columns) + 1))
+        updates = ', '.join(f'"{col}" = excluded."{col}"' for col in columns)
+        conn.executemany(f'INSERT INTO "{TABLE}" ({col_names}) VALUES ({placeholders}) '
+                         f'ON CONFLICT("Repo") DO UPDATE SET {updates}',
+                         zip(*values))
+    conn.close()
 
 
 def load_months_tracker() -> list[str]:
@@ -87,19 +202,24 @@ def load_blacklist() -> set:
     return blacklist
 
 
-def match_folder_to_row(folder_name: str, df: pd.DataFrame) -> pd.Series | None:
+def match_folders_to_rows(folder_names: list[str], df: pd.DataFrame) -> pd.DataFrame:
     """
-    Find row in the dataframe that corresponds to the given source folder
-    :param folder_name: Folder to find in the dataframe
+    Find the rows that correspond to a batch of source folders with a single join
+    Folders that are missing from the dataframe or appear in it multiple times are left out
+    :param folder_names: Folders to find in the dataframe
     :param df: Dataframe
-    :return: pandas Series if found, otherwise None
+    :return: Matching rows indexed by folder name, the repo name is kept in the 'Repo' column
     """
-    matches = df.query(f"Folder == '{folder_name}'").copy()
-    if len(matches) == 0:
+    folders = pd.Series(list(folder_names), dtype='string', name='Folder')
+    counts = df['Folder'].value_counts()
+
+    missing = folders[~folders.isin(counts.index)]
+    for folder_name in missing:
         print(f"Folder '{folder_name}' not found in DataFrame")
-        return None
-    if len(matches) > 1:
+    duplicated = folders[folders.isin(counts.index[counts > 1])]
+    for folder_name in duplicated:
         print(f"Folder '{folder_name}' appears in DataFrame multiple times")
-        return None
-    # exactly one match found
-    return matches.iloc[0]
+
+    unique = folders[folders.isin(counts.index[counts == 1])]
+    matches = df.reset_index().merge(unique, on='Folder', how='inner')
+    return matches.set_index('Folder')
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import sqlite3
+import zlib
+
+import numpy as np
+
+from .c_scanner import iter_tokens
+from .db_handler import DATA_DIR
+
+DEDUP_FILE = os.path.join(DATA_DIR, 'dedup.db')
+
+SHINGLE_SIZE = 5  # tokens per shingle
+NUM_PERM = 128  # number of MinHash permutations
+BANDS = 16  # LSH bands of NUM_PERM // BANDS rows each, candidates are pairs with similarity above ~0.7
+THRESHOLD = 0.8  # estimated Jaccard similarity above which a file is a near-duplicate
+CHUNK_SIZE = 4096  # shingles hashed at once, bounds memory use for very large files
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+# fixed seed so that signatures stay comparable between runs
+_rng = np.random.RandomState(1)
+PERM_A = _rng.randint(1, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+PERM_B = _rng.randint(0, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+
+
+def normalized_tokens(code: str) -> list[str]:
+    """
+    Tokens of C code without comments and whitespace, literals are replaced by placeholders
+    so that files differing only in formatting, comments or constants look the same
+    """
+    tokens = []
+    for kind, text in iter_tokens(code):
+        if kind in ('string', 'char', 'number'):
+            tokens.append(kind.upper())
+        else:
+            tokens.append(text)
+    return tokens
+
+
+def minhash(tokens: list[str]) -> np.ndarray | None:
+    """
+    MinHash signature of the token shingles
+    :return: Array of NUM_PERM uint32 values, or None if there are too few tokens for a single shingle
+    """
+    shingles = {zlib.crc32('\x00'.join(tokens[i:i + SHINGLE_SIZE]).encode())
+                for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+    if not shingles:
+        return None
+    hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+    signature = np.full(NUM_PERM, MAX_HASH, dtype=np.uint64)
+    for start in range(0, len(hashes), CHUNK_SIZE):
+        chunk = hashes[start:start + CHUNK_SIZE]
+        permuted = ((PERM_A[:, None] * chunk[None, :] + PERM_B[:, None]) % MERSENNE_PRIME) & MAX_HASH
+        signature = np.minimum(signature, permuted.min(axis=1))
+    return signature.astype(np.uint32)
+
+
+def fingerprint(code: str) -> (str, bytes | None):
+    """
+    Compute everything needed to check a file against the index, meant to run in worker processes
+    :param code: Source code
+    :return: Exact content hash and MinHash signature (None for very short files)
+    """
+    content_hash = hashlib.sha1(code.encode('utf-8', 'surrogatepass')).hexdigest()
+    signature = minhash(normalized_tokens(code))
+    return content_hash, None if signature is None else signature.tobytes()
+
+
+def _band_hashes(signature: bytes) -> list[int]:
+    band_size = len(signature) // BANDS
+    # 8 bytes of a digest fit SQLite's signed 64-bit integers
+    return [int.from_bytes(hashlib.blake2b(signature[i * band_size:(i + 1) * band_size], digest_size=8).digest(),
+                           'big', signed=True)
+            for i in range(BANDS)]
+
+
+class DedupIndex:
+    """
+    Persistent index of the files that are already in the dataset
+    Exact duplicates are found by content hash, near-duplicates by locality-sensitive hashing of MinHash signatures
+    """
+    def __init__(self, path: str = DEDUP_FILE, threshold: float = THRESHOLD):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.threshold = threshold
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "files" ('
+                          '"id" INTEGER PRIMARY KEY, "hash" TEXT UNIQUE, "repo" TEXT, "path" TEXT, "signature" BLOB)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "bands" ("band" INTEGER, "hash" INTEGER, "file_id" INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "idx_bands" ON "bands" ("band", "hash")')
+        self.conn.commit()
+
+    def find_duplicate(self, content_hash: str, signature: bytes | None,
+                       repo: str = None, path: str = None) -> tuple[str, str, str] | None:
+        """
+        :param content_hash: Exact content hash from fingerprint()
+        :param signature: MinHash signature from fingerprint()
+        :param repo: Repo of the file being checked, a file is never a duplicate of its own earlier entry
+        :param path: Path of the file being checked
+        :return: Tuple of duplicate type ('exact' or 'near'), repo and path of the indexed file, or None
+        """
+        row = self.conn.execute('SELECT "repo", "path" FROM "files" WHERE "hash" = ?', (content_hash,)).fetchone()
+        if row is not None and row == (repo, path):
+            # the same file indexed by an earlier run, e.g. when the dataset is rebuilt
+            return None
+        if row is not None:
+            return 'exact', row[0], row[1]
+        if signature is None:
+            return None
+
+        query = ' UNION '.join(['SELECT "file_id" FROM "bands" WHERE "band" = ? AND "hash" = ?'] * BANDS)
+        params = [value for band, band_hash in enumerate(_band_hashes(signature)) for value in (band, band_hash)]
+        candidates = [file_id for (file_id,) in self.conn.execute(query, params)]
+        if not candidates:
+            return None
+
+        own = np.frombuffer(signature, dtype=np.uint32)
+        placeholders = ', '.join('?' * len(candidates))
+        for other_repo, other_path, other in self.conn.execute(
+                f'SELECT "repo", "path", "signature" FROM "files" WHERE "id" IN ({placeholders})', candidates):
+            if (other_repo, other_path) == (repo, path):
+                continue
+            # share of equal signature values estimates the Jaccard similarity of the shingle sets
+            if np.mean(own == np.frombuffer(other, dtype=np.uint32)) >= self.threshold:
+                return 'near', other_repo, other_path
+        return None
+
+    def add(self, content_hash: str, signature: bytes | None, repo: str, path: str):
+        """
+        Add a file to the index, changes become permanent with commit()
+        """
+        cursor = self.conn.execute('INSERT OR IGNORE INTO "files" ("hash", "repo", "path", "signature") '
+                                   'VALUES (?, ?, ?, ?)', (content_hash, repo, path, signature))
+        if cursor.rowcount and signature is not None:
+            self.conn.executemany('INSERT INTO "bands" VALUES (?, ?, ?)',
+                                  [(band, band_hash, cursor.lastrowid)
+                                   for band, band_hash in enumerate(_band_hashes(signature))])
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,180 @@
+"""
+Identify executables by their magic bytes instead of calling the `file` utility.
+Classifications are cached by (path, inode, mtime) and can be persisted between processes,
+so files classified by Compiler don't need to be read again by Archiver.
+Builds append their classifications to the cache file, compact_cache drops the entries of files that are gone.
+"""
+
+import json
+import os
+import struct
+
+CACHE_FILE = os.path.join('out', 'filetype_cache.jsonl')  # one [path, inode, mtime_ns, file type] per line
+HEADER_SIZE = 64  # enough to cover ELF, Mach-O and MZ headers
+
+# ELF e_type values
+ET_REL, ET_EXEC, ET_DYN, ET_CORE = 1, 2, 3, 4
+# Mach-O filetype values
+MH_EXECUTE = 2
+MACHO_MAGIC = {
+    b'\xfe\xed\xfa\xce': '>', b'\xfe\xed\xfa\xcf': '>',  # big endian 32/64 bit
+    b'\xce\xfa\xed\xfe': '<', b'\xcf\xfa\xed\xfe': '<',  # little endian 32/64 bit
+}
+
+# (path) -> (inode, mtime_ns, file type)
+_cache: dict[str, tuple[int, int, str]] = {}
+# paths classified in this process since the last save_cache
+_unsaved: set[str] = set()
+
+
+def sniff(header: bytes) -> str:
+    """
+    Classify a file based on its first bytes
+    :param header: Beginning of the file (at least HEADER_SIZE bytes if the file is that long)
+    :return: One of 'elf-relocatable', 'elf-executable', 'elf-shared', 'elf-core', 'elf-other',
+    'macho-executable', 'macho-other', 'macho-universal', 'pe', 'script', 'archive', 'other'
+    """
+    if header.startswith(b'\x7fELF') and len(header) >= 18:
+        # EI_DATA: 1 is little endian, 2 is big endian
+        byteorder = '<' if header[5] == 1 else '>'
+        e_type = struct.unpack(byteorder + 'H', header[16:18])[0]
+        return {
+            ET_REL: 'elf-relocatable',
+            ET_EXEC: 'elf-executable',
+            ET_DYN: 'elf-shared',
+            ET_CORE: 'elf-core',
+        }.get(e_type, 'elf-other')
+    if header[:4] in MACHO_MAGIC and len(header) >= 16:
+        filetype = struct.unpack(MACHO_MAGIC[header[:4]] + 'I', header[12:16])[0]
+        return 'macho-executable' if filetype == MH_EXECUTE else 'macho-other'
+    if header.startswith(b'\xca\xfe\xba\xbe') and len(header) >= 8:
+        # Java class files share the magic number, but store a version (>= 45) instead of the arch count
+        if struct.unpack('>I', header[4:8])[0] < 20:
+            return 'macho-universal'
+        return 'other'
+    if header.startswith(b'MZ'):
+        return 'pe'
+    if header.startswith(b'#!'):
+        return 'script'
+    if header.startswith(b'!<arch>\n'):
+        return 'archive'
+    return 'other'
+
+
+def get_file_type(filepath: str) -> str:
+    """
+    Classify a file, reusing the cached result if the file hasn't changed since it was last classified
+    :param filepath: Path to the file
+    :return: File type as returned by sniff(), 'symlink' for symbolic links or 'missing' if the file doesn't exist
+    """
+    try:
+        stat = os.lstat(filepath)
+    except OSError:
+        return 'missing'
+    if os.path.islink(filepath):
+        return 'symlink'
+
+    cached = _cache.get(filepath)
+    if cached and cached[0] == stat.st_ino and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+
+    try:
+        with open(filepath, 'rb') as f:
+            file_type = sniff(f.read(HEADER_SIZE))
+    except OSError:
+        return 'missing'
+    _cache[filepath] = (stat.st_ino, stat.st_mtime_ns, file_type)
+    _unsaved.add(filepath)
+    return file_type
+
+
+def move_cached(old_path: str, new_path: str):
+    """
+    Carry over the classification of a file that was moved
+    The entry is only reused if the inode and mtime survived the move (i.e. it was a rename)
+    """
+    if old_path in _cache:
+        _cache[new_path] = _cache.pop(old_path)
+    if old_path in _unsaved:
+        _unsaved.discard(old_path)
+        _unsaved.add(new_path)
+
+
+def is_executable_type(file_type: str, filepath: str) -> bool:
+    """
+    Apply the executable filtering rules to a classified file
+    - files under 'CMakeFiles' are ignored
+    - shared objects count as executables unless they have the .so extension (PIE binaries are shared objects)
+    - scripts are text executables and are ignored
+    :param file_type: File type as returned by get_file_type()
+    :param filepath: Path to the file
+    :return: True or False
+    """
+    if 'CMakeFiles' in filepath:
+        return False
+    if file_type == 'elf-shared':
+        return os.path.splitext(filepath)[1] != '.so'
+    return file_type in ('elf-executable', 'macho-executable', 'macho-universal', 'pe')
+
+
+def _read_cache_file(cache_file: str) -> dict[str, tuple[int, int, str]]:
+    """
+    :return: Entries of the cache file by path, later lines replace earlier ones (empty if there is no file)
+    """
+    entries = {}
+    try:
+        with open(cache_file, 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    path, inode, mtime_ns, file_type = json.loads(line)
+                except ValueError:
+                    # a line cut short by a writer that was killed
+                    continue
+                entries[path] = (inode, mtime_ns, file_type)
+    except OSError:
+        pass
+    return entries
+
+
+def load_cache(cache_file: str = CACHE_FILE):
+    """
+    Load classifications saved by other processes
+    """
+    for path, entry in _read_cache_file(cache_file).items():
+        _cache.setdefault(path, entry)
+
+
+def save_cache(cache_file: str = CACHE_FILE):
+    """
+    Append the classifications made since the last call to the cache file
+    The entries are handed over to the file and dropped from this process, so a long run of builds doesn't keep them
+    all in memory. Each call writes its lines at once to the end of the file, concurrent writers don't mix them.
+    """
+    lines = [json.dumps([path, *_cache.pop(path)]) + '\n' for path in _unsaved
+             if path in _cache and os.path.lexists(path)]
+    _unsaved.clear()
+    if not lines:
+        return
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    fd = os.open(cache_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, ''.join(lines).encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def compact_cache(cache_file: str = CACHE_FILE):
+    """
+    Rewrite the cache file with one entry per file and without the files that don't exist anymore
+    (e.g. the builds of removed repos). It checks every entry, so it runs once per run or at an interval.
+    The file is replaced atomically, entries appended by other processes in the meantime can be lost, not corrupted
+    """
+    if not os.path.isfile(cache_file):
+        return
+    entries = _read_cache_file(cache_file)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wt', encoding='utf-8') as f:
+        for path, entry in entries.items():
+            if os.path.lexists(path):
+                f.write(json.dumps([path, *entry]) + '\n')
+    os.replace(tmp_file, cache_file)
@@ -0,0 +1,165 @@
+import http.client
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from .db_handler import DATA_DIR
+
+load_dotenv()
+
+CACHE_FILE = os.path.join(DATA_DIR, 'http_cache.db')
+ENABLED = os.getenv('HTTP_CACHE', '1') != '0'
+CACHED_STATUSES = {200, 404}  # 404 is meaningful too, e.g. a repo without releases
+
+HOUR = 3600
+DAY = 24 * HOUR
+# how long a cached response is used without asking the server, first matching pattern wins
+# after that it's revalidated with a conditional request, which doesn't count against the rate limit if unchanged
+TTL_POLICIES = [
+    (re.compile(r'/search/'), 0),  # results change all the time and can't be revalidated
+    (re.compile(r'/zipball'), 0),  # archives are streamed, not cached
+    (re.compile(r'/git/tags/[0-9a-f]+$'), 365 * DAY),  # tag objects are addressed by their hash
+    (re.compile(r'/git/ref/tags/'), 7 * DAY),
+    (re.compile(r'/languages$'), 7 * DAY),
+    (re.compile(r'/releases/latest$'), DAY),
+    (re.compile(r'/branches/'), HOUR),
+    (re.compile(r'/repos/[^/]+/[^/]+$'), DAY),
+]
+DEFAULT_TTL = HOUR
+
+stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    # sqlite connections can't be shared between threads, so every thread gets its own
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        conn = sqlite3.connect(CACHE_FILE, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS "responses" ('
+                     '"key" TEXT PRIMARY KEY, "status" INTEGER, "headers" TEXT, "body" BLOB, "fetched" REAL)')
+        _local.conn = conn
+    return conn
+
+
+def _count(stat: str):
+    with _stats_lock:
+        stats[stat] += 1
+
+
+def get_ttl(url: str) -> int:
+    """
+    :param url: Request url
+    :return: Number of seconds a response can be used without revalidation, 0 if it shouldn't be cached at all
+    """
+    path = requests.utils.urlparse(url).path
+    for pattern, ttl in TTL_POLICIES:
+        if pattern.search(path):
+            return ttl
+    return DEFAULT_TTL
+
+
+def cache_key(url: str, params: dict = None) -> str:
+    return requests.Request('GET', url, params=params).prepare().url
+
+
+def _build_response(key: str, status: int, headers: dict, body: bytes) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response.reason = http.client.responses.get(status, '')
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = body
+    response.url = key
+    response.encoding = 'utf-8'
+    return response
+
+
+def lookup(key: str) -> (requests.Response | None, bool):
+    """
+    :param key: Cache key of the request
+    :return: Cached response (or None) and whether it's still fresh according to its TTL
+    """
+    row = _connect().execute('SELECT "status", "headers", "body", "fetched" FROM "responses" WHERE "key" = ?',
+                             (key,)).fetchone()
+    if row is None:
+        return None, False
+    status, headers, body, fetched = row
+    fresh = time.time() - fetched < get_ttl(key)
+    return _build_response(key, status, json.loads(headers), body), fresh
+
+
+def conditional_headers(cached: requests.Response) -> dict:
+    """
+    Headers that let the server answer with 304 Not Modified if the cached response is still valid
+    """
+    headers = {}
+    if 'etag' in cached.headers:
+        headers['If-None-Match'] = cached.headers['etag']
+    if 'last-modified' in cached.headers:
+        headers['If-Modified-Since'] = cached.headers['last-modified']
+    return headers
+
+
+def store(key: str, response: requests.Response):
+    if response.status_code not in CACHED_STATUSES:
+        return
+    conn = _connect()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO "responses" VALUES (?, ?, ?, ?, ?)',
+                     (key, response.status_code, json.dumps(dict(response.headers)), response.content, time.time()))
+
+
+def touch(key: str):
+    """
+    Mark a cached response as fresh again after the server confirmed it hasn't changed
+    """
+    conn = _connect()
+    with conn:
+        conn.execute('UPDATE "responses" SET "fetched" = ? WHERE "key" = ?', (time.time(), key))
+
+
+def get_cached(url: str, params: dict, fetch) -> requests.Response:
+    """
+    Answer a GET request from the cache, revalidate a stale response or fetch and cache a new one
+    :param url: Request url
+    :param params: Query parameters
+    :param fetch: Function that sends the request, takes a dictionary of extra headers and returns the response
+    :return: Response
+    """
+    if not ENABLED or get_ttl(url) == 0:
+        return fetch({})
+
+    key = cache_key(url, params)
+    cached, fresh = lookup(key)
+    if cached is not None and fresh:
+        _count('hits')
+        return cached
+
+    response = fetch(conditional_headers(cached) if cached is not None else {})
+    if response.status_code == 304 and cached is not None:
+        _count('revalidated')
+        touch(key)
+        return cached
+
+    _count('misses')
+    store(key, response)
+    return response
+
+
+def format_stats() -> str:
+    with _stats_lock:
+        total = sum(stats.values())
+        hit_rate = (stats['hits'] + stats['revalidated']) / total if total else 0
+        return (f"HTTP cache: {stats['hits']} hits, {stats['revalidated']} revalidated, "
+                f"{stats['misses']} misses ({hit_rate:.0%} served from cache)")
@@ -0,0 +1,51 @@
+"""
+Runs a build command and reports its resource usage, see compiler.run_subprocess
+Linux counts the memory a process had before exec in its max RSS, so a command started directly by the compiler
+would report at least the memory of the Python process that started it. This script runs in a small interpreter
+(python -S -I) and forks the command itself, so the reported max RSS is the command's own.
+
+Usage: python -S -I launcher.py <report fd> [<resource>=<soft>:<hard> ...] -- <command> [args]
+The resource limits (e.g. AS=4294967296:4294967296 for resource.RLIMIT_AS) are set before the command is executed.
+The report fd gets a line 'usage <user seconds> <system seconds> <max RSS in KB>' when the command is done,
+after a line 'error <message>' if the command couldn't be started
+"""
+import os
+import resource
+import signal
+import sys
+
+
+def main(argv: list[str]) -> int:
+    separator = argv.index('--')
+    report_fd = int(argv[0])
+    limits = [arg.partition('=') for arg in argv[1:separator]]
+    command = argv[separator + 1:]
+
+    # a timeout terminates the whole process group, the launcher stays until the command is gone to report it
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    pid = os.fork()
+    if pid == 0:
+        # ignored signals stay ignored after exec
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            for name, _, values in limits:
+                soft, hard = values.split(':')
+                resource.setrlimit(getattr(resource, f"RLIMIT_{name}"), (int(soft), int(hard)))
+            os.execvp(command[0], command)
+        except (OSError, ValueError) as e:
+            os.write(report_fd, f"error {command[0]}: {getattr(e, 'strerror', None) or e}\n".encode())
+            os._exit(127)
+
+    _, status, rusage = os.wait4(pid, 0)
+    code = os.waitstatus_to_exitcode(status)
+    os.write(report_fd, f"usage {rusage.ru_utime} {rusage.ru_stime} {rusage.ru_maxrss}\n".encode())
+    if code < 0:
+        # end the same way as the command, so the caller sees the signal
+        if -code != signal.SIGKILL:
+            signal.signal(-code, signal.SIG_DFL)
+        os.kill(os.getpid(), -code)
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import shutil
+
+from dotenv import load_dotenv
+
+from .build_cache import CACHE_DIR, toolchain_versions
+from .c_scanner import scan_c_source
+
+load_dotenv()
+
+OBJECT_CACHE_DIR = os.path.join(*os.getenv('OBJECT_CACHE_DIR', os.path.join(CACHE_DIR, 'objects')).split('/'))
+OBJECT_CACHE_SIZE = float(os.getenv('OBJECT_CACHE_SIZE', 2048))  # max size of the object cache in MB
+
+
+class IncludeResolver:
+    """
+    Finds the headers of the repo that a file includes, directly or through other headers
+    Includes are looked up next to the including file and then in the include directories, like gcc does
+    Headers that can't be found in the repo (system headers) are covered by the compiler version in the cache key
+    """
+    def __init__(self, root: str, include_dirs: list[str]):
+        """
+        :param root: Root directory of the repository
+        :param include_dirs: Directories passed to the compiler with -I (relative to root)
+        """
+        self.root = root
+        self.include_dirs = [os.path.join(root, path) for path in include_dirs]
+        # header path -> (content hash, resolved paths of the headers it includes)
+        self.headers: dict[str, tuple[str, list[str]]] = {}
+
+    def resolve(self, names: list[str], directory: str) -> list[str]:
+        """
+        :param names: Included file names as written in the #include directives
+        :param directory: Directory of the including file
+        :return: Paths of the included files that exist in the repo
+        """
+        found = []
+        for name in names:
+            for include_dir in [directory] + self.include_dirs:
+                path = os.path.normpath(os.path.join(include_dir, name))
+                if os.path.isfile(path):
+                    found.append(path)
+                    break
+        return found
+
+    def _header(self, path: str) -> tuple[str, list[str]]:
+        if path not in self.headers:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            includes = scan_c_source(raw.decode('utf-8', errors='replace'))['includes']
+            self.headers[path] = (hashlib.sha1(raw).hexdigest(), self.resolve(includes, os.path.dirname(path)))
+        return self.headers[path]
+
+    def closure(self, includes: list[str], directory: str) -> list[tuple[str, str]]:
+        """
+        :param includes: File names included by a source file
+        :param directory: Directory of the source file
+        :return: Sorted (path relative to root, content hash) of every repo header the source file depends on
+        """
+        seen = {}
+        stack = self.resolve(includes, directory)
+        while stack:
+            path = stack.pop()
+            if path in seen:
+                continue
+            try:
+                content_hash, nested = self._header(path)
+            except OSError:
+                continue
+            seen[path] = content_hash
+            stack.extend(nested)
+        return sorted((os.path.relpath(path, self.root), content_hash) for path, content_hash in seen.items())
+
+
+def object_key(source: str, source_hash: str, headers: list[tuple[str, str]], flags: list[str]) -> str:
+    """
+    :param source: Path of the source file relative to the repo root, it can end up in the object (__FILE__)
+    :param source_hash: Hash of the source file contents
+    :param headers: Repo headers the source file depends on, see IncludeResolver.closure
+    :param flags: Compiler flags
+    :return: Hex digest identifying the object file
+    """
+    key = {
+        'source': source,
+        'source_hash': source_hash,
+        'headers': headers,
+        'flags': flags,
+        'compiler': toolchain_versions()['gcc'],
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _entry_path(key: str, suffix: str) -> str:
+    # a level of subdirectories keeps the directories small
+    return os.path.join(OBJECT_CACHE_DIR, key[:2], key + suffix)
+
+
+def fetch(key: str, target: str, suffix: str = '.o') -> bool:
+    """
+    Copy a cached object file
+    :param key: Cache key from object_key
+    :param target: Path to copy the object to
+    :param suffix: Kind of file stored under the key, e.g. '.d' for the dependency file made along with an object
+    :return: Whether the object was in the cache
+    """
+    entry = _entry_path(key, suffix)
+    try:
+        shutil.copyfile(entry, target)
+        # the modification time marks when the entry was last used
+        os.utime(entry)
+    except OSError:
+        return False
+    return True
+
+
+def store(key: str, source: str, suffix: str = '.o'):
+    """
+    Add an object file to the cache, the entry is replaced in one step so a concurrent fetch never sees it half written
+    """
+    entry = _entry_path(key, suffix)
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    tmp_entry = f"{entry}.{os.getpid()}.tmp"
+    try:
+        shutil.copyfile(source, tmp_entry)
+        os.replace(tmp_entry, entry)
+    except OSError as e:
+        print(f"Could not cache object file {source}: {e}")
+
+
+def evict(limit_mb: float = OBJECT_CACHE_SIZE):
+    """
+    Remove least recently used object files until the cache fits the size limit
+    """
+    entries = []
+    for root, _, files in os.walk(OBJECT_CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    limit = limit_mb * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
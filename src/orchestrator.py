@@ -0,0 +1,297 @@
+import argparse
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+
+import pandas as pd
+
+from . import build_cache, object_cache
+from .archiver import archive_repo, is_archivable
+from .compiler import (BUILD_DIR, LOG_DIR, SOURCE_DIR, compile_repo, init_worker, jobs_per_build, record_result,
+                       saved_build)
+from .compiler_cache import MODES as COMPILER_CACHE_MODES, summary
+from .db_handler import initialize, wrapup
+from .filetype import compact_cache, load_cache
+from .sandbox import MODES as SANDBOX_MODES
+from .scraper import MEDIA_EXTENSIONS
+from .toggler import download_to_disk, remove_from_disk
+
+ZIP_DIR = os.path.join('out', 'zip')
+POLL_INTERVAL = 5  # seconds between checks of the free disk space while nothing else happens
+EVICT_INTERVAL = 100  # builds between two cleanups of the caches, each one walks a whole cache
+MB = 1024 * 1024
+
+
+def remove_repo(folder: str, row: pd.Series) -> bool:
+    """
+    Remove the source and build files of a repo, zip archives are kept
+    :param folder: Name of the repo folder
+    :param row: Dataframe row of the repo
+    :return: Whether the source folder still exists (expected False)
+    """
+    shutil.rmtree(os.path.join(BUILD_DIR, folder), ignore_errors=True)
+    return remove_from_disk(row)
+
+
+class Pipeline:
+    """
+    Runs download, compile, archive and remove as concurrent stages, each repo moves on as soon as it's ready
+    Downloads run in threads, builds and archives in worker processes, removals in a small thread pool
+    Every stage reports back to the main thread, which is the only one that changes and saves the dataframe
+    """
+    def __init__(self, df: pd.DataFrame, candidates: list[str], max_in_flight: int = 32, min_free: int = 10240,
+                 download_jobs: int = 8, compile_jobs: int = 2, archive_jobs: int = 2, skip_media: bool = False,
+                 use_cache: bool = False, sandbox_mode: str = None, compiler_cache_mode: str = None,
+                 verbose: bool = False):
+        """
+        :param df: Dataframe with all repo data
+        :param candidates: Repos to process, in this order
+        :param max_in_flight: Max number of repos between the start of their download and their removal
+        :param min_free: Free disk space in MB that has to remain after a download before it's started
+        :param download_jobs: Number of concurrent downloads
+        :param compile_jobs: Number of concurrent builds, they share the CPU budget of the compiler (BUILD_CPUS)
+        :param archive_jobs: Number of repos archived concurrently
+        :param skip_media: Don't extract images, audio, video, fonts and PDFs from downloaded repos
+        :param use_cache: Use the build cache (see compiler)
+        :param sandbox_mode: Build in scratch working trees, one of sandbox.MODES (optional)
+        :param compiler_cache_mode: Run the compilers of build systems through a compiler cache,
+        one of compiler_cache.MODES (optional)
+        :param verbose: Verbose compiler output
+        """
+        self.df = df
+        self.candidates = deque(candidates)
+        self.max_in_flight = max_in_flight
+        self.min_free = min_free * MB
+        self.skip_ext = MEDIA_EXTENSIONS if skip_media else None
+        self.use_cache = use_cache
+        self.sandbox_mode = sandbox_mode
+        self.compiler_cache_mode = compiler_cache_mode
+        self.cache_stats = {'hits': 0, 'misses': 0}
+
+        self.in_flight: dict[str, str | None] = {}  # repo -> folder, None until its download is done
+        self.events = queue.Queue()  # (stage, repo, future) of finished tasks
+        self.stopping = False
+        self.waiting_for_space = False
+        self.done = 0
+        self.compiled = 0
+
+        # worker processes are spawned, forking a process that runs threads isn't safe
+        context = multiprocessing.get_context('spawn')
+        self.download_pool = ThreadPoolExecutor(max_workers=download_jobs)
+        self.compile_pool = ProcessPoolExecutor(max_workers=compile_jobs, mp_context=context,
+                                                initializer=init_worker,
+                                                initargs=(verbose, jobs_per_build(compile_jobs)))
+        self.archive_pool = ProcessPoolExecutor(max_workers=archive_jobs, mp_context=context, initializer=load_cache)
+        self.remove_pool = ThreadPoolExecutor(max_workers=2)
+
+    def stop(self, *_):
+        """
+        Finish the repos in flight, but don't start new ones (SIGTERM handler)
+        """
+        if not self.stopping:
+            print("\n*** Process will terminate once the repos in progress are done. ***\n")
+        self.stopping = True
+
+    def _submit(self, stage: str, repo: str, pool, fn, *args):
+        future = pool.submit(fn, *args)
+        future.add_done_callback(lambda f: self.events.put((stage, repo, f)))
+
+    def _has_space(self, repo: str) -> bool:
+        # Size is the repo size in KB reported by GitHub
+        needed = self.min_free + int(self.df.at[repo, 'Size']) * 1024
+        return shutil.disk_usage(SOURCE_DIR).free >= needed
+
+    def _admit(self):
+        """
+        Start downloading repos until the in-flight limit is reached or the disk is too full
+        """
+        while not self.stopping and self.candidates and len(self.in_flight) < self.max_in_flight:
+            repo = self.candidates[0]
+            if not self._has_space(repo):
+                # try again later, once removals have freed some space
+                if not self.waiting_for_space:
+                    print(f"Waiting for free disk space before downloading {repo}")
+                self.waiting_for_space = True
+                return
+            self.waiting_for_space = False
+            self.candidates.popleft()
+            # the folder is only known once the archive is extracted
+            self.in_flight[repo] = None
+            self._submit('download', repo, self.download_pool,
+                         partial(download_to_disk, skip_ext=self.skip_ext), self.df.loc[repo].copy())
+
+    def _save(self, repo: str):
+        wrapup(data=self.df, rows=[repo])
+
+    def _on_download(self, repo: str, future: Future):
+        try:
+            folder, on_disk = future.result()
+        except Exception as e:
+            print(f"Could not download {repo}: {e}")
+            folder, on_disk = self.df.at[repo, 'Folder'], False
+        if not on_disk:
+            self.in_flight[repo] = folder
+            # clean up whatever was extracted before the failure
+            self._remove_later(repo)
+            return
+        self.df.at[repo, 'Folder'] = folder
+        self.df.at[repo, 'On_disk'] = True
+        self.in_flight[repo] = folder
+        self._save(repo)
+        row = self.df.loc[repo]
+        self._submit('compile', repo, self.compile_pool, compile_repo, folder, repo, row['Commit'],
+                     self.use_cache, False, self.sandbox_mode, saved_build(row), self.compiler_cache_mode)
+
+    def _on_compile(self, repo: str, future: Future):
+        try:
+            compiled = future.result()
+        except Exception as e:
+            print(f"Could not compile {repo}: {e}")
+            compiled = None
+        if compiled is not None:
+            record_result(self.df, repo, compiled)
+            self._save(repo)
+            self.compiled += 1
+            if self.compiled % EVICT_INTERVAL == 0:
+                self.remove_pool.submit(object_cache.evict)
+                self.remove_pool.submit(compact_cache)
+                if self.use_cache:
+                    self.remove_pool.submit(build_cache.evict)
+            for key, count in (compiled.get('Compiler_cache') or {}).items():
+                self.cache_stats[key] += count
+            # same checks as the standalone archiver
+            matches = self.df.loc[[repo]].reset_index().set_index('Folder')
+            if is_archivable(self.in_flight[repo], matches):
+                self._submit('archive', repo, self.archive_pool, archive_repo, self.in_flight[repo], ZIP_DIR)
+                return
+        self._remove_later(repo)
+
+    def _on_archive(self, repo: str, future: Future):
+        try:
+            archived = future.result()
+        except Exception as e:
+            print(f"Could not archive {repo}: {e}")
+            archived = False
+        if archived:
+            self.df.at[repo, 'Archived'] = True
+            self._save(repo)
+        self._remove_later(repo)
+
+    def _remove_later(self, repo: str):
+        # the row is copied, the dataframe is only touched by the main thread
+        self._submit('remove', repo, self.remove_pool, remove_repo, self.in_flight[repo], self.df.loc[repo].copy())
+
+    def _on_remove(self, repo: str, future: Future):
+        try:
+            still_on_disk = future.result()
+        except Exception as e:
+            print(f"Could not remove {repo}: {e}")
+            still_on_disk = True
+        self.df.at[repo, 'On_disk'] = still_on_disk
+        self._save(repo)
+        del self.in_flight[repo]
+        self.done += 1
+        print(f"DONE\t{repo} ({self.done} done, {len(self.in_flight)} in progress)")
+        self._check_source_dir()
+
+    def _check_source_dir(self):
+        """
+        Stop if the source directory contains anything but the repos in flight, like pipeline.sh did
+        Folders of repos that are still downloading are recognized by their prefix (owner-repo-)
+        """
+        expected = {folder for folder in self.in_flight.values() if folder is not None}
+        downloading = tuple(f"{repo.replace('/', '-')}-".lower()
+                            for repo, folder in self.in_flight.items() if folder is None)
+        leftovers = [name for name in os.listdir(SOURCE_DIR)
+                     if name not in expected and not name.lower().startswith(downloading)]
+        if leftovers and not self.stopping:
+            print(f"\n*** Stopping because {SOURCE_DIR} contains unexpected folders: {', '.join(leftovers[:5])} ***\n")
+            self.stop()
+
+    def run(self):
+        handlers = {
+            'download': self._on_download,
+            'compile': self._on_compile,
+            'archive': self._on_archive,
+            'remove': self._on_remove,
+        }
+        try:
+            while True:
+                self._admit()
+                if not self.in_flight and (self.stopping or not self.candidates):
+                    break
+                try:
+                    stage, repo, future = self.events.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                handlers[stage](repo, future)
+        finally:
+            for pool in (self.download_pool, self.compile_pool, self.archive_pool, self.remove_pool):
+                pool.shutdown(cancel_futures=True)
+            object_cache.evict()
+            compact_cache()
+            if self.use_cache:
+                build_cache.evict()
+        print(f"Processed {self.done} repos")
+        if self.compiler_cache_mode:
+            print(f"Compiler cache: {summary(self.cache_stats)}")
+
+
+def main(query: str = 'Last_comp.isna()', limit: int = None, **options):
+    """
+    :param query: Query that selects the repos to process, only repos that aren't on disk are picked
+    :param limit: Max number of repos to process (optional, all matching repos if not provided)
+    :param options: Arguments for Pipeline
+    """
+    os.makedirs(SOURCE_DIR, exist_ok=True)
+    os.makedirs(LOG_DIR, exist_ok=True)
+    os.makedirs(ZIP_DIR, exist_ok=True)
+    # the source directory has to be empty, leftovers of an interrupted run are removed with 'toggler remove'
+    if os.listdir(SOURCE_DIR):
+        print(f"*** Exiting because {SOURCE_DIR} is not empty ***")
+        return
+
+    df, _ = initialize()
+    selected = df.query(f"({query}) and ~On_disk" if query else '~On_disk')
+    candidates = selected.sample(frac=1).index.tolist()
+    if limit:
+        candidates = candidates[:limit]
+    print(f"{len(candidates)} repos to process")
+
+    pipeline = Pipeline(df, candidates, **options)
+    signal.signal(signal.SIGTERM, pipeline.stop)
+    pipeline.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download, compile, archive and remove repos in overlapping stages")
+    parser.add_argument('--q', type=str, default='Last_comp.isna()',
+                        help="Query that selects the repos to process (default 'Last_comp.isna()')")
+    parser.add_argument('--limit', type=int, help="Max number of repos to process (optional)")
+    parser.add_argument('--max-in-flight', type=int, default=32,
+                        help="Max number of repos downloaded but not yet removed (default 32)")
+    parser.add_argument('--min-free', type=int, default=10240,
+                        help="Don't start a download unless this many MB of disk space would remain (default 10240)")
+    parser.add_argument('--download-jobs', type=int, default=8, help="Number of concurrent downloads (default 8)")
+    parser.add_argument('--compile-jobs', type=int, default=2, help="Number of concurrent builds (default 2)")
+    parser.add_argument('--archive-jobs', type=int, default=2,
+                        help="Number of repos archived concurrently (default 2)")
+    parser.add_argument('--skip-media', action='store_true',
+                        help="Do not extract images, audio, video, fonts and PDFs when downloading")
+    parser.add_argument('--cache', action='store_true', help="Use the build cache (see src.compiler --cache)")
+    parser.add_argument('--sandbox', nargs='?', const='auto', choices=SANDBOX_MODES,
+                        help="Build every repo in its own scratch working tree (see src.compiler --sandbox)")
+    parser.add_argument('--compiler-cache', nargs='?', const='auto', choices=COMPILER_CACHE_MODES,
+                        help="Run the compilers of build systems through a compiler cache "
+                             "(see src.compiler --compiler-cache)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Verbose compiler output")
+    args = parser.parse_args()
+    main(query=args.q, limit=args.limit, max_in_flight=args.max_in_flight, min_free=args.min_free,
+         download_jobs=args.download_jobs, compile_jobs=args.compile_jobs, archive_jobs=args.archive_jobs,
+         skip_media=args.skip_media, use_cache=args.cache, sandbox_mode=args.sandbox,
+         compiler_cache_mode=args.compiler_cache, verbose=args.verbose)
@@ -0,0 +1,55 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: allows bursts of up to `capacity` requests, refilled at `rate` requests per second
+    """
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, blocking until one is available
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api
+# primary limit for authenticated requests: 5000 per hour
+CORE_BUCKET = TokenBucket(rate=5000 / 3600, capacity=100)
+# search API: 30 requests per minute
+SEARCH_BUCKET = TokenBucket(rate=30 / 60, capacity=30)
+# code search has its own, stricter limit: 10 requests per minute
+CODE_SEARCH_BUCKET = TokenBucket(rate=10 / 60, capacity=10)
+# GraphQL is limited by query cost (5000 points per hour), a batch of repos costs about one point
+GRAPHQL_BUCKET = TokenBucket(rate=5000 / 3600, capacity=100)
+
+
+def bucket_for(url: str) -> TokenBucket:
+    """
+    Pick the rate limit that a request to the given GitHub API url counts against
+    """
+    path = urlparse(url).path
+    if path.endswith('/graphql'):
+        return GRAPHQL_BUCKET
+    if path.endswith('/search/code'):
+        return CODE_SEARCH_BUCKET
+    if '/search/' in path:
+        return SEARCH_BUCKET
+    return CORE_BUCKET
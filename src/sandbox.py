@@ -0,0 +1,139 @@
+import functools
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+
+from .build_cache import link_or_copy
+from .snapshot import Snapshot
+
+SANDBOX_DIR = os.path.join('out', 'sandbox')
+MODES = ['auto', 'overlay', 'copy']
+
+# mounts the overlay over the repo directory itself, so the build sees the usual paths but only writes to the upper layer
+# arguments: repo (lower layer and mount point), upper layer, overlayfs work directory, cwd, command...
+OVERLAY_SCRIPT = ('mount -t overlay overlay -o "lowerdir=$1,upperdir=$2,workdir=$3" "$1" '
+                  '&& cd "$4" && shift 4 && exec "$@"')
+
+
+@functools.cache
+def unshare_prefix() -> list[str] | None:
+    """
+    Find a way to mount overlayfs in a private mount namespace, checked once per process
+    Root can use a plain mount namespace, other users need a user namespace (Linux 5.11+)
+    :return: Command prefix that runs a command in a new mount namespace, or None if overlays aren't available
+    """
+    candidates = [['unshare', '--user', '--map-root-user', '--mount']]
+    if os.geteuid() == 0:
+        candidates.insert(0, ['unshare', '--mount'])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        layers = [os.path.join(tmp_dir, name) for name in ('lower', 'upper', 'work')]
+        for layer in layers:
+            os.mkdir(layer)
+        for prefix in candidates:
+            try:
+                probe = subprocess.run(prefix + ['sh', '-c', OVERLAY_SCRIPT, 'sh', *layers, layers[0], 'true'],
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                continue
+            if probe.returncode == 0:
+                return prefix
+    return None
+
+
+def _remove_tree(path: str):
+    # overlayfs leaves a directory without any permissions in its work directory
+    leftover = os.path.join(path, 'work', 'work')
+    if os.path.isdir(leftover):
+        os.chmod(leftover, 0o700)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class Sandbox:
+    """
+    Scratch working tree for a single build, so that the build can't change the downloaded repo
+    - 'overlay': the build runs in its own mount namespace with an overlay over the repo directory,
+    everything it writes ends up in the upper layer
+    - 'copy': the build runs in a copy of the repo made of hard links, files that compilers and linkers replace
+    don't affect the original, but a file modified in place is modified in the repo as well
+    - 'auto': overlay if the system supports it, otherwise copy
+    Removing the scratch directory removes everything the build left behind
+    """
+    def __init__(self, repo_path: str, scratch_dir: str, mode: str = 'auto'):
+        """
+        :param repo_path: Root directory of the repository
+        :param scratch_dir: Directory for the sandbox, it's removed first if it already exists
+        :param mode: 'overlay', 'copy' or 'auto'
+        """
+        self.repo_path = repo_path
+        self.scratch_dir = scratch_dir
+        _remove_tree(scratch_dir)
+        os.makedirs(scratch_dir)
+
+        self.prefix = unshare_prefix() if mode in ('auto', 'overlay') else None
+        if mode == 'overlay' and self.prefix is None:
+            print("Overlay sandbox not available, using a copy of the repo instead")
+        self.overlay = self.prefix is not None
+
+        if self.overlay:
+            # the build sees the repo at its usual path
+            self.root = repo_path
+            self.upper = os.path.join(scratch_dir, 'upper')
+            self.work = os.path.join(scratch_dir, 'work')
+            os.mkdir(self.upper)
+            os.mkdir(self.work)
+        else:
+            self.root = os.path.join(scratch_dir, 'tree')
+            shutil.copytree(repo_path, self.root, symlinks=True, copy_function=link_or_copy)
+            self.before = Snapshot().add(self.root)
+
+    def wrap(self, command: list[str], cwd: str) -> (list[str], str | None):
+        """
+        Make a command run inside the sandbox
+        :param command: Command to run
+        :param cwd: Directory to run it in (inside the sandbox root)
+        :return: Command and cwd to pass to subprocess
+        """
+        if not self.overlay:
+            return command, cwd
+        paths = [os.path.abspath(path) for path in (self.repo_path, self.upper, self.work, cwd)]
+        return self.prefix + ['sh', '-c', OVERLAY_SCRIPT, 'sh'] + paths + command, None
+
+    def changes(self) -> (list[str], list[str]):
+        """
+        :return: Paths of the files created and of the files modified by the build, pointing into the sandbox
+        """
+        if not self.overlay:
+            return self.before.diff(Snapshot().add(self.root))
+
+        created, modified = [], []
+        for root, _, files in os.walk(self.upper):
+            for name in files:
+                path = os.path.join(root, name)
+                mode = os.lstat(path).st_mode
+                # deleted files are marked by character devices in the upper layer
+                if stat.S_ISCHR(mode):
+                    continue
+                if os.path.lexists(os.path.join(self.repo_path, self.relpath(path))):
+                    modified.append(path)
+                else:
+                    created.append(path)
+        return created, modified
+
+    def output_path(self, relpath: str) -> str:
+        """
+        :param relpath: Path relative to the repo root
+        :return: Where a file made outside the sandbox has to be put to show up in the tree at this path
+        """
+        return os.path.join(self.upper if self.overlay else self.root, relpath)
+
+    def relpath(self, path: str) -> str:
+        """
+        :param path: Path to a file in the sandbox
+        :return: Path relative to the repo root
+        """
+        return os.path.relpath(path, self.upper if self.overlay else self.root)
+
+    def remove(self):
+        _remove_tree(self.scratch_dir)
@@ -1,19 +1,25 @@
 import argparse
+import asyncio
 import csv
 import datetime
-import gc
 import glob
 import os
+import tempfile
+import threading
 import time
+from types import SimpleNamespace
 import zipfile
 
 from dotenv import load_dotenv
 from github import Github, Repository
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
+from . import http_cache
 from .db_handler import initialize, wrapup, load_blacklist
+from .rate_limit import bucket_for
 
 load_dotenv()
 
@@ -22,8 +28,31 @@ SIZE_LIMIT = float(os.getenv('SIZE_LIMIT'))  # size limit for downloading repos
 SAVE_DIR = os.path.join(*os.getenv('SOURCE_DIR').split('/'))
 LOG_DIR = os.path.join('out', 'logs')
 
-BASE_ENDPOINT = 'https://api.github.com'
+BASE_ENDPOINT = os.getenv('API_ENDPOINT', 'https://api.github.com')  # can point to a local mock server
+GRAPHQL_ENDPOINT = os.getenv('GRAPHQL_ENDPOINT', f'{BASE_ENDPOINT}/graphql')
+GRAPHQL_BATCH_SIZE = 50  # repos per GraphQL request
+GRAPHQL_RETRIES = 5  # attempts of a GraphQL request that runs into the rate limit
 HEADERS = {'Authorization': f'token {TOKEN}'}
+POOL_SIZE = 16  # max number of kept-alive connections per host
+CHUNK_SIZE = 1024 * 1024  # size of the chunks in which archives are downloaded and extracted
+SPOOL_LIMIT = 16 * 1024 * 1024  # downloaded archives larger than this are buffered on disk instead of in memory
+
+# files that are not needed for compilation and can be skipped when extracting
+MEDIA_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.ico', '.svg', '.webp', '.tif', '.tiff', '.psd',
+    '.mp3', '.wav', '.ogg', '.flac', '.mp4', '.avi', '.mov', '.mkv', '.webm',
+    '.pdf', '.ttf', '.otf', '.woff', '.woff2',
+}
+
+# one session for all requests so that connections are reused, also shared between download threads
+session = requests.Session()
+session.headers.update(HEADERS)
+for prefix in ['https://', 'http://']:
+    session.mount(prefix, HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+
+# when a rate limit is hit, every thread waits until this timestamp before sending new requests
+_rate_limit_lock = threading.Lock()
+_rate_limited_until = 0.0
 
 blacklist = set()  # list of ignored repos
 
@@ -80,11 +109,14 @@ def is_eligible_repo(repo: Repository, v: bool = True) -> bool:
     return True
 
 
-def download_repo(repo_name: str, commit: str = None) -> str | None:
+def download_repo(repo_name: str, commit: str = None, skip_ext: set[str] = None) -> str | None:
     """
     Download either latest available release of a repo or a specified commit state
+    The archive is streamed into a spooled buffer (in memory up to SPOOL_LIMIT, on disk above it)
+    and extracted member by member, so memory use doesn't depend on the repo size
     :param repo_name: Full name of the repo in the format 'owner/repo'
     :param commit: Commit hash (optional)
+    :param skip_ext: File extensions (lowercase, with the dot) that should not be extracted (optional)
     :return: Name of the folder containing repo files or None if not downloaded
     """
     repo_name = repo_name.lower()
@@ -105,34 +137,232 @@ def download_repo(repo_name: str, commit: str = None) -> str | None:
             dwnld_type = 'main'
         else:
             print(f"Not downloaded, status code {release.status_code}")
-            gc.collect()
             return
 
-    response = fetch_response(dwnld_url)
-    zip_path = os.path.join(SAVE_DIR, repo_name.replace('/', '-') + '.zip')
-    os.makedirs(os.path.dirname(zip_path), exist_ok=True)
-    with open(zip_path, 'wb') as f:
-        f.write(response.content)
-    try:
-        with zipfile.ZipFile(zip_path, 'r') as f:
-            # get the folder name from inside the zip
-            # it should be the prefix of the first item on the list
-            folder_name = f.namelist()[0].split('/')[0]
-            # extract the zip file
-            f.extractall(SAVE_DIR)
-    finally:
-        os.remove(zip_path)
+    os.makedirs(SAVE_DIR, exist_ok=True)
+    response = fetch_response(dwnld_url, stream=True)
+    with response, tempfile.SpooledTemporaryFile(max_size=SPOOL_LIMIT, dir=SAVE_DIR) as buffer:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            buffer.write(chunk)
+        buffer.seek(0)
+        folder_name = extract_zip(buffer, SAVE_DIR, skip_ext)
     print(f"    Done -> {folder_name}")
-    gc.collect()
     return folder_name
 
 
-def scrape_whole_month(df: pd.DataFrame, month: str, repo_limit: int = None) -> pd.DataFrame:
+def extract_zip(file, target: str, skip_ext: set[str] = None) -> str:
+    """
+    Extract a zip archive one member at a time
+    :param file: Path or file-like object of the zip archive
+    :param target: Directory to extract the archive to
+    :param skip_ext: File extensions (lowercase, with the dot) that should not be extracted (optional)
+    :return: Name of the top-level folder inside the archive
+    """
+    with zipfile.ZipFile(file, 'r') as f:
+        members = f.infolist()
+        # get the folder name from inside the zip
+        # it should be the prefix of the first item on the list
+        folder_name = members[0].filename.split('/')[0]
+        for member in members:
+            if skip_ext and os.path.splitext(member.filename)[1].lower() in skip_ext:
+                continue
+            # members are copied in chunks, never read into memory as a whole
+            f.extract(member, target)
+    return folder_name
+
+
+def make_row(repo_name: str, month: str, size: int, stars: int, languages: dict, commit_hash: str) -> pd.DataFrame:
+    """
+    Create a single-row dataframe for a newly scraped repo
+    """
+    new_row = pd.DataFrame([{
+        'Repo': repo_name.lower(),
+        'Commit': commit_hash,
+        'Pushed': month,
+        'Size': size,
+        'Stars': stars,
+        'C_ratio': get_c_ratio(languages),
+        'Langs': languages,
+        'Folder': '-'.join([repo_name.replace('/', '-'), commit_hash]),
+        'On_disk': False,
+        'Archived': False,
+    }])
+    new_row = new_row.astype({
+        'Repo': 'string',
+        'Commit': 'string',
+        'Pushed': 'string',
+        'Size': 'int32',
+        'Stars': 'int32',
+        'C_ratio': 'float32',
+        'Langs': 'object',
+        'Folder': 'string',
+        'On_disk': 'bool',
+        'Archived': 'bool',
+    })
+    new_row.set_index('Repo', inplace=True)
+    return new_row
+
+
+def scrape_repo(repo: Repository, month: str) -> pd.DataFrame | None:
+    """
+    Check the eligibility of a repo and look up its remaining details
+    :param repo: PyGithub repository or any object with the same attributes
+    (full_name, size, description, stargazers_count, languages_url)
+    :param month: Month the repo was found for
+    :return: Single-row dataframe or None if the repo is not eligible
+    """
+    if not is_eligible_repo(repo, v=False):
+        return None
+    languages = fetch_response(repo.languages_url).json()
+    commit_hash = get_latest_release_hash(repo.full_name)
+    return make_row(repo.full_name, month, repo.size, repo.stargazers_count, languages, commit_hash)
+
+
+def _repo_from_item(item: dict) -> SimpleNamespace:
+    # search results already contain the repo details, no need to request them again
+    return SimpleNamespace(full_name=item['full_name'],
+                           size=item['size'],
+                           description=item['description'],
+                           stargazers_count=item['stargazers_count'],
+                           languages_url=item['languages_url'])
+
+
+async def scrape_repos_async(items: list[dict], month: str, concurrency: int, graphql: bool = False) -> dict:
+    """
+    Scrape several repos from the search results concurrently
+    Requests are sent from worker threads through the shared session, so they still go through
+    the rate limit buckets and the retry handling of fetch_response
+    :param items: Repo objects returned by the search API
+    :param month: Month the repos were found for
+    :param concurrency: Max number of requests in flight at the same time
+    :param graphql: Look up the details of eligible repos in batches through the GraphQL API
+    :return: Dictionary of repo name -> single-row dataframe, None if filtered or the exception that was raised
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(func, *args):
+        async with semaphore:
+            return await asyncio.to_thread(func, *args)
+
+    repos = [_repo_from_item(item) for item in items]
+    if not graphql:
+        results = await asyncio.gather(*(run(scrape_repo, repo, month) for repo in repos), return_exceptions=True)
+        return {repo.full_name: result for repo, result in zip(repos, results)}
+
+    eligible = await asyncio.gather(*(run(is_eligible_repo, repo, False) for repo in repos), return_exceptions=True)
+    scraped = {repo.full_name: (result if isinstance(result, Exception) else None)
+               for repo, result in zip(repos, eligible)}
+    names = [repo.full_name for repo, result in zip(repos, eligible) if result is True]
+    batches = [names[i:i + GRAPHQL_BATCH_SIZE] for i in range(0, len(names), GRAPHQL_BATCH_SIZE)]
+    metadata = await asyncio.gather(*(run(fetch_repo_metadata, batch) for batch in batches), return_exceptions=True)
+    for batch, batch_metadata in zip(batches, metadata):
+        for name in batch:
+            if isinstance(batch_metadata, Exception):
+                scraped[name] = batch_metadata
+            elif batch_metadata.get(name) is None:
+                scraped[name] = Exception("not found in the GraphQL response")
+            else:
+                repo = batch_metadata[name]
+                scraped[name] = make_row(name, month, repo['size'], repo['stars'], repo['languages'], repo['commit'])
+    return scraped
+
+
+class GraphQLError(Exception):
+    """
+    Exception raised when a GraphQL request fails as a whole (no data, rate limit, query errors).
+    """
+
+
+def fetch_repo_metadata(repo_names: list[str]) -> dict[str, dict | None]:
+    """
+    Look up the details of several repos with a single GraphQL request
+    Replaces the separate REST calls for repo info, languages, latest release, tag and default branch
+    :param repo_names: Full names of the repos in the format 'owner/repo'
+    :return: See parse_repo_metadata
+    :raises GraphQLError: If the request failed as a whole, e.g. it's still rate limited after GRAPHQL_RETRIES attempts
+    """
+    global _rate_limited_until
+    fields = []
+    variables = {}
+    for i, repo_name in enumerate(repo_names):
+        owner, name = repo_name.split('/', 1)
+        variables[f'owner{i}'] = owner
+        variables[f'name{i}'] = name
+        fields.append(f'r{i}: repository(owner: $owner{i}, name: $name{i}) {{ ...RepoFields }}')
+    declarations = ', '.join(f'$owner{i}: String!, $name{i}: String!' for i in range(len(repo_names)))
+    query = (f'query({declarations}) {{ {" ".join(fields)} }}\n'
+             'fragment RepoFields on Repository {'
+             ' diskUsage stargazerCount description'
+             ' languages(first: 100, orderBy: {field: SIZE, direction: DESC}) { edges { size node { name } } }'
+             ' latestRelease { tagCommit { oid } }'
+             ' defaultBranchRef { target { oid } }'
+             ' }')
+
+    for _ in range(GRAPHQL_RETRIES):
+        response = fetch_response(GRAPHQL_ENDPOINT, json_body={'query': query, 'variables': variables})
+        body = response.json()
+        if not any(error.get('type') == 'RATE_LIMITED' for error in body.get('errors') or []):
+            return parse_repo_metadata(repo_names, body)
+        # the GraphQL API reports an exhausted rate limit in the response body, not with a status code
+        if 'x-ratelimit-reset' in response.headers:
+            delay = max(int(response.headers['x-ratelimit-reset']) - int(time.time()), 1)
+        else:
+            delay = 60
+        assert delay < 600, "Delay too long"
+        print(f"\nGraphQL rate limit, retry in {delay}s...")
+        with _rate_limit_lock:
+            _rate_limited_until = max(_rate_limited_until, time.time() + delay)
+    raise GraphQLError(f"Still rate limited after {GRAPHQL_RETRIES} attempts")
+
+
+def parse_repo_metadata(repo_names: list[str], body: dict) -> dict[str, dict | None]:
+    """
+    :param repo_names: Full names of the repos in the order of the aliases (r0, r1, ...) in the query
+    :param body: JSON body of the GraphQL response
+    :return: Dictionary of repo name -> dictionary with 'size', 'stars', 'description', 'languages' and
+    'commit' (latest release commit or default branch head, first 7 characters), None if the repo wasn't found
+    :raises GraphQLError: If the response has no data or errors other than repos that weren't found
+    """
+    errors = body.get('errors') or []
+    data = body.get('data')
+    # a repo that doesn't exist (or isn't visible) only nulls its own alias, anything else fails the batch
+    failures = [error for error in errors if error.get('type') != 'NOT_FOUND']
+    if data is None or failures:
+        messages = '; '.join(error.get('message', str(error)) for error in failures or errors)
+        raise GraphQLError(messages or "No data in the GraphQL response")
+
+    metadata = {}
+    for i, repo_name in enumerate(repo_names):
+        repo = data.get(f'r{i}')
+        if repo is None:
+            metadata[repo_name] = None
+            continue
+        # same preference as get_latest_release_hash: latest release if available, otherwise the default branch
+        if repo['latestRelease'] and repo['latestRelease']['tagCommit']:
+            commit_sha = repo['latestRelease']['tagCommit']['oid']
+        elif repo['defaultBranchRef'] and repo['defaultBranchRef']['target']:
+            commit_sha = repo['defaultBranchRef']['target']['oid']
+        else:
+            commit_sha = None
+        metadata[repo_name] = {
+            'size': repo['diskUsage'],
+            'stars': repo['stargazerCount'],
+            'description': repo['description'],
+            'languages': {edge['node']['name']: edge['size'] for edge in repo['languages']['edges']},
+            'commit': commit_sha[:7] if commit_sha else None,
+        }
+    return metadata
+
+
+def scrape_whole_month(df: pd.DataFrame, month: str, repo_limit: int = None, concurrency: int = 1,
+                       graphql: bool = False) -> pd.DataFrame:
     """
     Scrapes data about top 1000 repos updated in a specified month
     :param df: Dataframe where the data should be saved
     :param month: Month to search for
     :param repo_limit: (optional) Max amount of repos to scrape - can be used for debug purposes
+    :param concurrency: (optional) Number of repos looked up at the same time (default 1)
+    :param graphql: (optional) Look up repo details in batches through the GraphQL API (default False)
     :return Updated dataframe
     """
     repo_count = 0
@@ -155,6 +385,12 @@ def scrape_whole_month(df: pd.DataFrame, month: str, repo_limit: int = None) ->
             print(f"\nError during GitHub search: {e}")
             page += 1
             continue
+        if concurrency > 1 or graphql:
+            # look up all new repos on the page at once
+            candidates = [item for item in results['items'] if item['full_name'].lower() not in df.index]
+            scraped = asyncio.run(scrape_repos_async(candidates, month, concurrency, graphql))
+
+        page_rows = []
         for item in tqdm(results['items']):
             repo_name = item['full_name']
             if repo_name.lower() in df.index:
@@ -162,36 +398,15 @@ def scrape_whole_month(df: pd.DataFrame, month: str, repo_limit: int = None) ->
                 filtered_count += 1
                 continue
             try:
-                repo = g.get_repo(repo_name)
-                if is_eligible_repo(repo, v=False):
-                    languages = fetch_response(repo.languages_url).json()
-                    commit_hash = get_latest_release_hash(repo_name)
-                    new_row = pd.DataFrame([{
-                        'Repo': repo_name.lower(),
-                        'Commit': commit_hash,
-                        'Pushed': month,
-                        'Size': repo.size,
-                        'Stars': repo.stargazers_count,
-                        'C_ratio': get_c_ratio(languages),
-                        'Langs': languages,
-                        'Folder': '-'.join([repo_name.replace('/', '-'), commit_hash]),
-                        'On_disk': False,
-                        'Archived': False,
-                    }])
-                    new_row = new_row.astype({
-                        'Repo': 'string',
-                        'Commit': 'string',
-                        'Pushed': 'string',
-                        'Size': 'int32',
-                        'Stars': 'int32',
-                        'C_ratio': 'float32',
-                        'Langs': 'object',
-                        'Folder': 'string',
-                        'On_disk': 'bool',
-                        'Archived': 'bool',
-                    })
-                    new_row.set_index('Repo', inplace=True)
+                if concurrency > 1 or graphql:
+                    new_row = scraped[repo_name]
+                    if isinstance(new_row, Exception):
+                        raise new_row
+                else:
+                    new_row = scrape_repo(g.get_repo(repo_name), month)
+                if new_row is not None:
                     df = pd.concat([df, new_row], axis=0)
+                    page_rows.append(repo_name.lower())
                 else:
                     filtered_count += 1
                     continue
@@ -209,7 +424,7 @@ def scrape_whole_month(df: pd.DataFrame, month: str, repo_limit: int = None) ->
             break
 
         # save the dataframe to file after every page to avoid losing progress if the script breaks
-        wrapup(data=df)
+        wrapup(data=df, rows=page_rows)
         page += 1
 
         # debug
@@ -278,10 +493,47 @@ def get_latest_release_hash(repo_name: str) -> str | None:
         return None
 
 
-def fetch_response(url: str, params: dict = None, raise_for_status: bool = True) -> requests.Response:
+def fetch_response(url: str, params: dict = None, raise_for_status: bool = True,
+                   stream: bool = False, json_body: dict = None) -> requests.Response:
+    """
+    Send a request to the GitHub API, waiting out rate limits
+    GET responses are served from the HTTP cache if possible (streamed responses are never cached)
+    :param url: Request url
+    :param params: Query parameters (optional)
+    :param raise_for_status: Raise an HTTPError for error status codes (default True)
+    :param stream: Don't download the response body immediately (default False)
+    :param json_body: Send a POST request with this JSON body instead of a GET request (optional)
+    :return: Response
+    """
+    if stream or json_body is not None:
+        response = _send_request(url, params, stream=stream, json_body=json_body)
+    else:
+        response = http_cache.get_cached(url, params, lambda headers: _send_request(url, params, headers))
+
+    if raise_for_status:
+        response.raise_for_status()
+
+    return response
+
+
+def _send_request(url: str, params: dict = None, headers: dict = None, stream: bool = False,
+                  json_body: dict = None) -> requests.Response:
+    global _rate_limited_until
+
     default_delay = 5
     while default_delay <= 120:
-        response = requests.get(url, headers=HEADERS, params=params)
+        # wait out a rate limit that another thread has run into
+        with _rate_limit_lock:
+            wait = _rate_limited_until - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        # stay within the rate limit budget of the endpoint instead of waiting to be blocked
+        bucket_for(url).acquire()
+        if json_body is not None:
+            response = session.post(url, params=params, headers=headers, json=json_body)
+        else:
+            response = session.get(url, params=params, headers=headers, stream=stream)
 
         # Too Many Requests / Forbidden
         if response.status_code in [429, 403]:
@@ -301,21 +553,21 @@ def fetch_response(url: str, params: dict = None, raise_for_status: bool = True)
             assert delay < 600, "Delay too long"
 
             print(f"\nRetry in {delay}s...")
-            time.sleep(delay)
+            with _rate_limit_lock:
+                _rate_limited_until = max(_rate_limited_until, time.time() + delay)
             continue
 
-        if raise_for_status:
-            response.raise_for_status()
-
         return response
 
 
-def main():
+def main(concurrency: int = 1, graphql: bool = False):
     df, months = initialize()
     next_month = get_next_month(months)
-    df = scrape_whole_month(df, next_month)
+    scraped_before = df.index
+    df = scrape_whole_month(df, next_month, concurrency=concurrency, graphql=graphql)
     months.append(next_month)
-    wrapup(df, months)
+    wrapup(df, months, rows=df.index.difference(scraped_before))
+    print(http_cache.format_stats())
 
 
 if __name__ == "__main__":
@@ -323,11 +575,15 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--months', type=int, default=0,
                         help='Number of months to scrape (defaults to 0 for no limit)')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Number of repos looked up at the same time (defaults to 1)')
+    parser.add_argument('--graphql', action='store_true',
+                        help='Look up repo details in batches through the GraphQL API instead of one by one')
     args = parser.parse_args()
 
     if args.months == 0:
         while True:
-            main()
+            main(args.concurrency, args.graphql)
     else:
         for _ in range(args.months):
-            main()
+            main(args.concurrency, args.graphql)
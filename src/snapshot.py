@@ -0,0 +1,238 @@
+import ctypes
+import errno
+import os
+import struct
+import time
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_ONLYDIR | IN_DONT_FOLLOW)
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+READ_SIZE = 64 * 1024
+
+
+def _scan(top: str, recurse: bool, exclude: set[str], visit_file, visit_dir=None):
+    """
+    Walk a directory tree with os.scandir, calling visit_file(entry) for every file
+    and visit_dir(path) for every directory that is descended into, the top included
+    Symbolic links (to directories too) are reported as files and not followed, the same as inotify reports them
+    """
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        if visit_dir is not None:
+            visit_dir(path)
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recurse and os.path.abspath(entry.path) not in exclude:
+                                stack.append(entry.path)
+                        else:
+                            visit_file(entry)
+                    except OSError:
+                        continue
+        except OSError:
+            # the directory disappeared or can't be read
+            continue
+
+
+class Snapshot:
+    """
+    State of the files in a set of directories: path -> (size, mtime_ns, inode)
+    Paths are joined onto the given top directories, so they're relative if the top directories are
+    """
+    def __init__(self):
+        self.files: dict[str, tuple[int, int, int]] = {}
+
+    def add(self, top: str, recurse: bool = True, exclude: set[str] = frozenset()) -> 'Snapshot':
+        """
+        Record the files in a directory
+        :param top: Directory to scan
+        :param recurse: Scan subdirectories too
+        :param exclude: Absolute paths of subdirectories to skip
+        :return: The snapshot itself
+        """
+        def visit(entry: os.DirEntry):
+            stat = entry.stat(follow_symlinks=False)
+            self.files[entry.path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+        _scan(top, recurse, exclude, visit)
+        return self
+
+    def diff(self, after: 'Snapshot') -> (list[str], list[str]):
+        """
+        :param after: Later snapshot of the same directories
+        :return: Paths of the files that were created and of the files that were modified (or replaced) in between
+        """
+        created, modified = [], []
+        for path, state in after.files.items():
+            before = self.files.get(path)
+            if before is None:
+                created.append(path)
+            elif before != state:
+                modified.append(path)
+        return created, modified
+
+
+class SnapshotTracker:
+    """
+    Find changed files by comparing snapshots taken before and after
+    """
+    def __init__(self):
+        self.dirs = []
+        self.before = Snapshot()
+
+    def watch(self, top: str, recurse: bool = True, exclude: set[str] = frozenset()):
+        self.dirs.append((top, recurse, exclude))
+        self.before.add(top, recurse, exclude)
+
+    def changes(self) -> (list[str], list[str]):
+        """
+        :return: Paths of the files created and modified since the directories started being watched
+        """
+        after = Snapshot()
+        for top, recurse, exclude in self.dirs:
+            after.add(top, recurse, exclude)
+        return self.before.diff(after)
+
+    def close(self):
+        pass
+
+
+class InotifyTracker:
+    """
+    Find changed files with inotify (Linux only), so the directories don't have to be walked a second time
+    Only directories are visited when a watch is set up, files are never stat'ed beforehand
+    Falls back to reporting every file modified since the watch started if the kernel's event queue overflows
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.watches: dict[int, str] = {}
+        self.dirs = []
+        self.started = time.time_ns()
+
+    def _watch_dir(self, path: str):
+        wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOENT:
+                # the directory is gone already
+                return
+            # ENOSPC means fs.inotify.max_user_watches is exhausted
+            raise OSError(error, os.strerror(error), path)
+        self.watches[wd] = path
+
+    def watch(self, top: str, recurse: bool = True, exclude: set[str] = frozenset()):
+        self.dirs.append((top, recurse, exclude))
+        _scan(top, recurse, exclude, lambda entry: None, self._watch_dir)
+
+    def _read_events(self):
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+                pos += EVENT_HEADER.size
+                name = data[pos:pos + length].rstrip(b'\0')
+                pos += length
+                yield wd, mask, os.fsdecode(name)
+
+    def changes(self) -> (list[str], list[str]):
+        """
+        :return: Paths of the files created and modified since the directories started being watched
+        """
+        created, modified = {}, {}
+        removed = set()  # files that existed before and were deleted, e.g. by a linker replacing its output
+        new_dirs = []
+        for wd, mask, name in self._read_events():
+            if mask & IN_Q_OVERFLOW:
+                print("inotify event queue overflowed, looking for changed files by modification time")
+                return [], self._modified_since_start()
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    new_dirs.append(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                # a file that is replaced counts as modified, like in Snapshot.diff
+                (modified if path in removed else created)[path] = None
+            elif mask & (IN_MODIFY | IN_ATTRIB) and path not in created:
+                modified[path] = None
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                if path in created:
+                    del created[path]
+                else:
+                    removed.add(path)
+                modified.pop(path, None)
+
+        # the contents of new directories weren't watched, but everything in them is new
+        for top in new_dirs:
+            _scan(top, True, frozenset(), lambda entry: created.setdefault(entry.path, None))
+        # a file may have been deleted after it was written
+        return ([path for path in created if os.path.lexists(path)],
+                [path for path in modified if os.path.lexists(path)])
+
+    def _modified_since_start(self) -> list[str]:
+        changed = []
+
+        def visit(entry: os.DirEntry):
+            stat = entry.stat(follow_symlinks=False)
+            if max(stat.st_mtime_ns, stat.st_ctime_ns) >= self.started:
+                changed.append(entry.path)
+
+        for top, recurse, exclude in self.dirs:
+            _scan(top, recurse, exclude, visit)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def start_tracking(dirs: list[tuple[str, bool, set[str]]], use_inotify: bool = False):
+    """
+    Start watching directories for created and modified files
+    :param dirs: Tuples of directory, whether to watch its subdirectories and absolute paths of subdirectories to skip
+    :param use_inotify: Track changes with inotify instead of comparing two snapshots, if the system supports it
+    :return: Tracker, call its changes() method to get the (created, modified) paths and close() when done
+    """
+    if use_inotify:
+        tracker = None
+        try:
+            tracker = InotifyTracker()
+            for top, recurse, exclude in dirs:
+                tracker.watch(top, recurse, exclude)
+            return tracker
+        except (OSError, AttributeError) as e:
+            # AttributeError: libc without inotify, e.g. not on Linux
+            print(f"inotify not available ({e}), comparing snapshots instead")
+            if tracker is not None:
+                tracker.close()
+    tracker = SnapshotTracker()
+    for top, recurse, exclude in dirs:
+        tracker.watch(top, recurse, exclude)
+    return tracker
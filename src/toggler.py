@@ -1,4 +1,6 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import os
 import shutil
 
@@ -7,16 +9,17 @@ import pandas as pd
 from requests.exceptions import HTTPError
 
 from .db_handler import initialize, wrapup
-from .scraper import download_repo
+from .scraper import download_repo, MEDIA_EXTENSIONS
 
 load_dotenv()
 SOURCE_DIR = os.path.join(*os.getenv('SOURCE_DIR').split('/'))
 
 
-def _download_to_disk(row: pd.Series) -> (str, bool):
+def download_to_disk(row: pd.Series, skip_ext: set[str] = None) -> (str, bool):
     """
     Helper function that downloads a repo to the source directory, to be applied row-wise
     :param row: Dataframe row containing data about the repo
+    :param skip_ext: File extensions that should not be extracted (optional)
     :return: Tuple(str, bool) where str is the updated name of the folder where repo files are stored
     and bool is confirmation whether this folder exists on disk (expected True)
     """
@@ -25,7 +28,7 @@ def _download_to_disk(row: pd.Series) -> (str, bool):
         shutil.rmtree(folder_path)
     try:
         # after the download is complete, factual folder name may differ from the expected one
-        updated_folder_name = download_repo(row.name, row['Commit'])
+        updated_folder_name = download_repo(row.name, row['Commit'], skip_ext)
         folder_path = os.path.join(SOURCE_DIR, updated_folder_name)
     except HTTPError as e:
         print(f"Could not download {row.name}: {e}")
@@ -36,7 +39,27 @@ def _download_to_disk(row: pd.Series) -> (str, bool):
             os.path.exists(folder_path) and os.path.isdir(folder_path))
 
 
-def _remove_from_disk(row: pd.Series) -> bool:
+def _download_all(sub_df: pd.DataFrame, jobs: int, skip_ext: set[str] = None) -> pd.DataFrame:
+    """
+    Download every repo in the dataframe, using several threads if requested
+    Threads share the scraper's connection pool and wait together when a rate limit is hit
+    :param sub_df: Dataframe with the repos to download
+    :param jobs: Max number of concurrent downloads
+    :param skip_ext: File extensions that should not be extracted (optional)
+    :return: Dataframe with the same index and columns 'Folder' and 'On_disk'
+    """
+    download = partial(download_to_disk, skip_ext=skip_ext)
+    if jobs > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            # map preserves the order of the rows
+            results = list(pool.map(download, (row for _, row in sub_df.iterrows())))
+        return pd.DataFrame(results, index=sub_df.index, columns=['Folder', 'On_disk'])
+    results = sub_df.apply(download, axis=1, result_type='expand')
+    results.columns = ['Folder', 'On_disk']
+    return results
+
+
+def remove_from_disk(row: pd.Series) -> bool:
     """
     Helper functions that removes a repo from the source directory, to be applied row-wise
     :param row: Dataframe row containing data about the repo
@@ -59,7 +82,14 @@ def _update_download_status(row: pd.Series) -> bool:
     return os.path.exists(folder_path) and os.path.isdir(folder_path)
 
 
-def execute_command(command: str, query: str = '', sample_size: int = None):
+def execute_command(command: str, query: str = '', sample_size: int = None, jobs: int = 1, skip_media: bool = False):
+    """
+    :param command: 'download', 'remove' or 'update'
+    :param query: Query to filter the dataframe (optional)
+    :param sample_size: Number of random repos to sample (optional)
+    :param jobs: Number of concurrent downloads (default 1)
+    :param skip_media: Don't extract images, audio, video, fonts and PDFs from downloaded repos
+    """
     df, _ = initialize()
     if not query:
         query = ''
@@ -92,8 +122,7 @@ def execute_command(command: str, query: str = '', sample_size: int = None):
         sub_df = sub_df.sample(n=sample_size)
 
     if command == 'download':
-        results = sub_df.apply(_download_to_disk, axis=1, result_type = 'expand')
-        results.columns = ['Folder', 'On_disk']
+        results = _download_all(sub_df, jobs, MEDIA_EXTENSIONS if skip_media else None)
         # filter only those rows that had a successful output
         filtered_results = results[(results['On_disk'] == True) &
                                    (results['Folder'].notna()) &
@@ -103,7 +132,7 @@ def execute_command(command: str, query: str = '', sample_size: int = None):
         print(f"Successfully downloaded {len(filtered_results)} repos.")
 
     elif command == 'remove':
-        result = sub_df.apply(_remove_from_disk, axis=1)
+        result = sub_df.apply(remove_from_disk, axis=1)
         df.loc[result.index, 'On_disk'] = result
         print(f"Successfully removed {len(result)} repos.")
 
@@ -119,7 +148,7 @@ def execute_command(command: str, query: str = '', sample_size: int = None):
     else:
         print("Invalid command. Please use 'download', 'remove' or 'update'.")
 
-    wrapup(data=df)
+    wrapup(data=df, rows=sub_df.index)
 
 
 if __name__ == "__main__":
@@ -127,7 +156,10 @@ if __name__ == "__main__":
     parser.add_argument('command', type=str, choices=['download', 'remove', 'update'], help='Command to execute')
     parser.add_argument('--q', type=str, help='Query to filter the dataframe (e.g., "Stars > 1000") (optional)')
     parser.add_argument('--size', type=int, help='Number of random repos to sample (optional)')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of concurrent downloads (default 1)')
+    parser.add_argument('--skip-media', action='store_true',
+                        help='Do not extract images, audio, video, fonts and PDFs when downloading')
 
     args = parser.parse_args()
 
-    execute_command(args.command, args.q, args.size)
+    execute_command(args.command, args.q, args.size, args.jobs, args.skip_media)
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# the modules read their folders from the environment on import
+os.environ.setdefault('SOURCE_DIR', 'test_source')
+os.environ.setdefault('COMPILE_DIR', 'test_compiled')
+os.environ.setdefault('SIZE_LIMIT', '100000')
+os.environ.setdefault('DATASET_SRC', 'test_source')
+os.environ.setdefault('DATASET_TARGET', 'test_dataset')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
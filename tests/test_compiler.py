@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from src.compiler import FILE_SIZE_LIMIT, MEMORY_LIMIT, compile_repo, run_subprocess
+
+
+def new_usage() -> dict:
+    return {'Cpu_user': 0.0, 'Cpu_sys': 0.0, 'Max_rss': 0, 'Wall_time': 0.0}
+
+
+def test_max_rss_is_the_command_own():
+    # memory of the calling process must not show up in the usage of the command
+    buffer = bytearray(500 * 1024 * 1024)
+    usage = new_usage()
+    returncode, _, _ = run_subprocess(['true'], '.', usage=usage)
+    assert returncode == 0
+    assert 0 < usage['Max_rss'] < 20 * 1024
+    assert len(buffer)
+
+
+def test_output_and_returncode():
+    usage = new_usage()
+    returncode, stdout, stderr = run_subprocess(['sh', '-c', 'echo out; echo err >&2; exit 3'], '.', usage=usage)
+    assert (returncode, stdout, stderr) == (3, 'out\n', 'err\n')
+    assert usage['Wall_time'] > 0
+
+
+def test_missing_command():
+    returncode, stdout, stderr = run_subprocess(['no-such-build-tool'], '.', usage=new_usage())
+    assert returncode is None
+    assert 'no-such-build-tool' in stderr
+
+
+def test_limits_apply_to_the_command():
+    returncode, stdout, _ = run_subprocess(['sh', '-c', 'ulimit -v; ulimit -f'], '.', usage=new_usage())
+    assert returncode == 0
+    assert stdout.split() == [str(MEMORY_LIMIT * 1024), str(FILE_SIZE_LIMIT * 1024 * 1024 // 512)]
+
+
+def test_commands_from_threads():
+    # run_gcc runs its commands from a thread pool
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda i: run_subprocess(['sh', '-c', f'echo {i}'], '.'), range(32)))
+    assert [result[1] for result in results] == [f'{i}\n' for i in range(32)]
+
+
+class Built(Exception):
+    pass
+
+
+def test_nan_commit_skips_the_build_cache(tmp_path, monkeypatch):
+    # repos downloaded without a commit have NaN in the Commit column
+    (tmp_path / 'own-repo-123').mkdir()
+    monkeypatch.setattr('src.compiler.SOURCE_DIR', str(tmp_path))
+    monkeypatch.setattr('src.compiler.find_build', lambda repo_path, saved: ('make', 'Makefile', []))
+    monkeypatch.setattr('src.compiler.build_cache.cache_key', lambda *args: pytest.fail("cache used"))
+
+    def sandbox(*args):
+        raise Built()
+    monkeypatch.setattr('src.compiler.Sandbox', sandbox)
+    with pytest.raises(Built):
+        compile_repo('own-repo-123', 'own/repo', float('nan'), use_cache=True, sandbox_mode='copy')
@@ -0,0 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from dataset_creation import bounded_map
+
+
+def test_bounded_map_keeps_order_and_limits_pending_results():
+    lock = threading.Lock()
+    pending = 0
+    most_pending = 0
+
+    def task(i: int) -> int:
+        nonlocal pending, most_pending
+        with lock:
+            pending += 1
+            most_pending = max(most_pending, pending)
+        return i
+
+    results = []
+    with ThreadPoolExecutor(4) as pool:
+        for result in bounded_map(pool, task, range(50), 3):
+            results.append(result)
+            with lock:
+                pending -= 1
+    assert results == list(range(50))
+    assert most_pending <= 3
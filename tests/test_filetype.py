@@ -0,0 +1,28 @@
+import os
+
+from src import filetype
+
+
+def test_save_appends_new_entries_and_compact_drops_removed_files(tmp_path):
+    cache_file = str(tmp_path / 'filetype_cache.jsonl')
+    kept, removed = tmp_path / 'kept', tmp_path / 'removed'
+    for path in (kept, removed):
+        path.write_bytes(b'#!/bin/sh\n')
+        assert filetype.get_file_type(str(path)) == 'script'
+    filetype.save_cache(cache_file)
+    # saved entries leave the process
+    assert str(kept) not in filetype._cache
+
+    # only the new classification is appended
+    other = tmp_path / 'other'
+    other.write_bytes(b'\x7fELF')
+    filetype.get_file_type(str(other))
+    filetype.save_cache(cache_file)
+    with open(cache_file) as f:
+        assert len(f.readlines()) == 3
+
+    os.remove(removed)
+    filetype.compact_cache(cache_file)
+    filetype.load_cache(cache_file)
+    assert str(kept) in filetype._cache
+    assert str(removed) not in filetype._cache
@@ -0,0 +1,25 @@
+import os
+
+from src.snapshot import Snapshot, start_tracking
+
+
+def test_symlink_to_directory_is_reported_as_file(tmp_path):
+    (tmp_path / 'lib').mkdir()
+    (tmp_path / 'lib' / 'a.o').write_bytes(b'')
+    before = Snapshot().add(str(tmp_path))
+    os.symlink('lib', tmp_path / 'lib-link')
+    created, modified = before.diff(Snapshot().add(str(tmp_path)))
+    assert created == [str(tmp_path / 'lib-link')]
+    assert modified == []
+
+
+def test_trackers_agree_on_symlinks_to_directories(tmp_path):
+    (tmp_path / 'lib').mkdir()
+    results = []
+    for use_inotify in (False, True):
+        tracker = start_tracking([(str(tmp_path), True, frozenset())], use_inotify)
+        link = tmp_path / f'link-{use_inotify}'
+        os.symlink('lib', link)
+        results.append(tracker.changes() == ([str(link)], []))
+        tracker.close()
+    assert results == [True, True]